@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark for audit-iam-dap.py against a moto-backed synthetic account.
+
+Creates thousands of IAM users with random direct managed-policy attachments, then runs
+the auditor's phases without prompts: the per-user scan, the GetAccountAuthorizationDetails
+snapshot, planning, and applying the plan. Each phase reports wall time and IAM API calls
+by operation. After the migration it checks with plain per-user and per-group IAM calls
+that no user has a direct attachment left and that every user's groups grant exactly
+the policies that used to be attached directly, and exits 1 if not.
+
+USAGE:
+python audit-iam-dap-bench.py --users 3000 --group-by policy,policy-set
+python audit-iam-dap-bench.py --output iam-bench.json
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+import boto3
+from moto import mock_aws
+
+POLICY_DOCUMENT = json.dumps(
+    {
+        "Version": "2012-10-17",
+        "Statement": [{"Effect": "Allow", "Action": "s3:GetObject", "Resource": "*"}],
+    }
+)
+# Most users carry one or two direct policies; a few carry many, to exercise the
+# 10-policies-per-group split in policy-set mode.
+POLICIES_PER_USER = [1] * 40 + [2] * 30 + [3] * 15 + [5] * 10 + [12] * 5
+
+
+def load_auditor_module():
+    """Import audit-iam-dap.py from next to this script."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "audit-iam-dap.py")
+    spec = importlib.util.spec_from_file_location("audit_iam_dap", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_account_spec(user_count, policy_count, seed):
+    """Decide every synthetic user's direct policies up front, as user name -> policy names."""
+    rng = random.Random(seed)
+    policies = [f"bench-policy-{index:03d}" for index in range(policy_count)]
+    # A handful of popular policies, like a real account
+    weights = [1 / (index + 1) for index in range(policy_count)]
+    users = {}
+
+    for index in range(user_count):
+        wanted = min(rng.choice(POLICIES_PER_USER), policy_count)
+        chosen = set()
+        while len(chosen) < wanted:
+            chosen.update(rng.choices(policies, weights, k=wanted - len(chosen)))
+        users[f"bench-user-{index:05d}"] = sorted(chosen)
+    return policies, users
+
+
+def create_account(policies, users):
+    """Create the policies, users and direct attachments in moto; returns policy name -> ARN."""
+    iam = boto3.client("iam")
+    arns = {
+        name: iam.create_policy(PolicyName=name, PolicyDocument=POLICY_DOCUMENT)[
+            "Policy"
+        ]["Arn"]
+        for name in policies
+    }
+    for username, policy_names in users.items():
+        iam.create_user(UserName=username)
+        for name in policy_names:
+            iam.attach_user_policy(UserName=username, PolicyArn=arns[name])
+    return arns
+
+
+class CallCounter:
+    """Count IAM API calls by operation on every client made from the default session."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+    def register(self, session):
+        session.events.register("before-parameter-build.iam", self._count)
+
+    def _count(self, model, **kwargs):
+        with self.lock:
+            self.calls[model.name] += 1
+
+    def take(self):
+        """Return the calls counted since the last take() and start again."""
+        with self.lock:
+            calls, self.calls = self.calls, Counter()
+        return calls
+
+
+def run_phase(report, counter, name, function, *args):
+    """Run one phase quietly, recording wall time and API calls under report[name]."""
+    counter.take()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args)
+    calls = counter.take()
+    report[name] = {
+        "wall_seconds": round(time.perf_counter() - started, 3),
+        "api_calls": sum(calls.values()),
+        "by_operation": dict(sorted(calls.items())),
+    }
+    return result
+
+
+def verify_migration(iam_client, users, arns):
+    """
+    Return a list of problems with the post-migration state (empty when it's right).
+
+    Reads IAM directly rather than through the auditor's snapshot, so a bug in the
+    auditor's indexing can't hide one in the migration. Groups with inline policies
+    count as a problem, since the users never had those permissions directly.
+    """
+    group_policies = {}
+
+    def policies_of(group_name):
+        if group_name not in group_policies:
+            if iam_client.list_group_policies(GroupName=group_name)["PolicyNames"]:
+                group_policies[group_name] = None
+            else:
+                group_policies[group_name] = {
+                    policy["PolicyArn"]
+                    for page in iam_client.get_paginator(
+                        "list_attached_group_policies"
+                    ).paginate(GroupName=group_name)
+                    for policy in page["AttachedPolicies"]
+                }
+        return group_policies[group_name]
+
+    problems = []
+    for username, policy_names in users.items():
+        direct = [
+            policy
+            for page in iam_client.get_paginator(
+                "list_attached_user_policies"
+            ).paginate(UserName=username)
+            for policy in page["AttachedPolicies"]
+        ]
+        if direct:
+            problems.append(f"{username} still has {len(direct)} direct policies")
+        granted = set()
+        for page in iam_client.get_paginator("list_groups_for_user").paginate(
+            UserName=username
+        ):
+            for group in page["Groups"]:
+                policies = policies_of(group["GroupName"])
+                if policies is None:
+                    problems.append(
+                        f"{username} is in {group['GroupName']}, which has inline policies"
+                    )
+                else:
+                    granted |= policies
+        expected = {arns[name] for name in policy_names}
+        if granted != expected:
+            problems.append(
+                f"{username}: groups grant {len(granted)} policies, "
+                f"expected {len(expected)}"
+            )
+    return problems
+
+
+def run_migration(module, policies, users, group_by, workers, mutation_rate):
+    """Build a fresh account, then scan, plan and apply it with one grouping mode."""
+    report = {}
+    counter = CallCounter()
+
+    with mock_aws():
+        # mock_aws drops the default session on entry, so hook the fresh one here
+        boto3.setup_default_session()
+        counter.register(boto3.DEFAULT_SESSION)
+        started = time.perf_counter()
+        arns = create_account(policies, users)
+        counter.take()
+        report["setup_seconds"] = round(time.perf_counter() - started, 3)
+
+        iam_client = module.make_iam_client(workers)
+        module.mutation_limiter.configure(mutation_rate, mutation_rate)
+        phases = report.setdefault("phases", {})
+
+        user_list = run_phase(
+            phases, counter, "list_users", module.list_all_users, iam_client
+        )
+        scanned, _ = run_phase(
+            phases,
+            counter,
+            "scan",
+            module.scan_direct_policies,
+            iam_client,
+            user_list,
+            workers,
+        )
+        snapshot = run_phase(
+            phases,
+            counter,
+            "snapshot",
+            module.load_authorization_snapshot,
+            iam_client,
+        )
+        from_snapshot, _ = module.scan_snapshot(snapshot)
+        if len(scanned) != len(from_snapshot):
+            print(f"❌ Scan found {len(scanned)} users, snapshot {len(from_snapshot)}")
+            sys.exit(1)
+
+        plan = run_phase(
+            phases,
+            counter,
+            "plan",
+            module.build_migration_plan,
+            from_snapshot,
+            set(snapshot["group_policies"]),
+            snapshot,
+            group_by,
+        )
+        report["plan"] = {phase: len(plan[phase]) for phase in module.PLAN_PHASES}
+
+        with tempfile.TemporaryDirectory() as workdir:
+            run_phase(
+                phases,
+                counter,
+                "apply",
+                module.apply_migration_plan,
+                module.make_iam_client(workers, mutations=True),
+                plan,
+                os.path.join(workdir, "plan.checkpoint"),
+                workers,
+            )
+        report["limiter"] = {
+            key: round(value, 2)
+            for key, value in module.mutation_limiter.stats().items()
+        }
+
+        report["problems"] = verify_migration(iam_client, users, arns)
+    return report
+
+
+def print_report(report):
+    print(
+        f"\n📊 IAM auditor benchmark: {report['users']} users, "
+        f"{report['policies']} policies, seed {report['seed']}"
+    )
+    for group_by, result in report["modes"].items():
+        print(f"\n▶ group-by {group_by} (setup {result['setup_seconds']:.1f}s)")
+        for phase, numbers in result["phases"].items():
+            print(
+                f"  {phase:<12} {numbers['wall_seconds']:>8.2f}s "
+                f"{numbers['api_calls']:>7} calls"
+            )
+        print("  plan: " + ", ".join(f"{k}={v}" for k, v in result["plan"].items()))
+        limiter = result["limiter"]
+        print(
+            f"  writes: {limiter['ops']:.0f} at {limiter['ops_per_sec']:.1f} ops/s, "
+            f"{limiter['retries']:.0f} retries"
+        )
+        if result["problems"]:
+            print(f"  ❌ {len(result['problems'])} problems, e.g.:")
+            for problem in result["problems"][:10]:
+                print(f"    • {problem}")
+        else:
+            print("  ✅ No direct attachments left; memberships match the old policies")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark audit-iam-dap.py against a synthetic moto account"
+    )
+    parser.add_argument(
+        "--users", type=int, default=2000, help="Synthetic users to create"
+    )
+    parser.add_argument(
+        "--policies", type=int, default=40, help="Managed policies to spread over them"
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=16, help="Auditor workers")
+    parser.add_argument(
+        "--group-by",
+        default="policy,policy-set",
+        help="Comma-separated grouping modes to migrate with, each on a fresh account",
+    )
+    parser.add_argument(
+        "--mutation-rate",
+        type=float,
+        default=1000.0,
+        help="IAM write rate for the limiter (moto never throttles, so default high)",
+    )
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    module = load_auditor_module()
+    policies, users = build_account_spec(args.users, args.policies, args.seed)
+
+    report = {
+        "users": args.users,
+        "policies": args.policies,
+        "seed": args.seed,
+        "modes": {},
+    }
+    for group_by in args.group_by.split(","):
+        report["modes"][group_by] = run_migration(
+            module, policies, users, group_by, args.workers, args.mutation_rate
+        )
+
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"\n💾 Report written to {args.output}")
+
+    if any(result["problems"] for result in report["modes"].values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,23 +3,295 @@
 """
 This script is used to audit IAM users for directly attached policies.
 It will create a new IAM group for each policy and add the user to the group.
+
+Usage: audit-iam-dap.py [--snapshot] [--state FILE] [--plan FILE | --apply FILE]
+See --help for every option.
 """
 
+import argparse
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import (
+    BotoCoreError,
+    ClientError,
+    ConnectionError as BotoConnectionError,
+    HTTPClientError,
+)
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import os
+import random
 import re
+import threading
+import time
+
+DEFAULT_WORKERS = 16
+MAX_ATTEMPTS = 10  # per read call, including throttled retries
+
+# IAM write limiter: start at MUTATION_RATE ops/s, add MUTATION_RATE_STEP ops/s per
+# second of successful calls up to MAX_MUTATION_RATE, halve on throttling
+MUTATION_RATE = 5.0
+MIN_MUTATION_RATE = 0.5
+MAX_MUTATION_RATE = 20.0
+MUTATION_RATE_STEP = 1.0
+MAX_MUTATION_ATTEMPTS = 8
+THROTTLE_CODES = {"Throttling", "ThrottlingException", "RequestLimitExceeded"}
+# Failures worth retrying without slowing down: IAM 5xx (ServiceFailure) and dropped or
+# timed-out connections
+TRANSIENT_ERRORS = (BotoConnectionError, HTTPClientError)
+
+# CloudTrail's event history only goes back 90 days, and events can take up to 15
+# minutes to show up, so lookups start that much before the previous audit.
+CLOUDTRAIL_RETENTION = timedelta(days=90)
+CLOUDTRAIL_DELIVERY_LAG = timedelta(minutes=15)
+POLICY_CHANGE_EVENTS = ("AttachUserPolicy", "DetachUserPolicy")
+
+# IAM's default quota on managed policies attached to one group
+MAX_POLICIES_PER_GROUP = 10
+GROUPING_MODES = ("policy", "policy-set")
+
+# Plan phases, in the order they are applied. A detach only runs once the membership
+# and group attach it depends on have succeeded.
+PLAN_PHASES = (
+    "create_groups",
+    "attach_group_policies",
+    "add_memberships",
+    "detach_user_policies",
+)
+
+
+def make_iam_client(workers=DEFAULT_WORKERS, mutations=False):
+    """
+    Create an IAM client sized for the worker pool.
+
+    Read clients get botocore's adaptive, throttle-aware retries. Clients for writes
+    (mutations=True) make a single attempt per call, leaving retries to mutation_limiter
+    so only one engine backs off.
+    """
+    if mutations:
+        retries = {"max_attempts": 1, "mode": "standard"}
+    else:
+        retries = {"max_attempts": MAX_ATTEMPTS, "mode": "adaptive"}
+    return boto3.client(
+        "iam",
+        config=Config(retries=retries, max_pool_connections=max(workers, 10)),
+    )
+
+
+class MutationRateLimiter:
+    """Token bucket with additive-increase/multiplicative-decrease shared by IAM writes."""
+
+    def __init__(self, rate=MUTATION_RATE, max_rate=MAX_MUTATION_RATE):
+        self.lock = threading.Lock()
+        self.configure(rate, max_rate)
+
+    def configure(self, rate, max_rate=MAX_MUTATION_RATE):
+        """Set the starting and ceiling rates, and reset the counters."""
+        with self.lock:
+            self.max_rate = max(max_rate, rate)
+            self.rate = rate
+            self.tokens = 1.0
+            self.refilled_at = time.monotonic()
+            self.started_at = None
+            self.finished_at = None
+            self.ops = 0
+            self.retries = 0
+            self.throttles = 0
+
+    def _acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if self.started_at is None:
+                    self.started_at = now
+                burst = max(1.0, self.rate)
+                self.tokens = min(
+                    burst, self.tokens + (now - self.refilled_at) * self.rate
+                )
+                self.refilled_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def _succeeded(self):
+        with self.lock:
+            self.ops += 1
+            self.finished_at = time.monotonic()
+            self.rate = min(self.max_rate, self.rate + MUTATION_RATE_STEP / self.rate)
+
+    def _throttled(self):
+        with self.lock:
+            self.retries += 1
+            self.throttles += 1
+            self.rate = max(MIN_MUTATION_RATE, self.rate / 2)
+
+    def _failed_transiently(self):
+        with self.lock:
+            self.retries += 1
+
+    def call(self, operation, **kwargs):
+        """
+        Run one IAM write at the current rate, retrying throttles and transient failures.
+
+        Throttles lower the rate; 5xx responses and connection errors are retried with
+        backoff at the same rate. operation should come from a
+        make_iam_client(mutations=True) client, so these reach the limiter instead of
+        being retried inside botocore.
+        """
+        for attempt in range(MAX_MUTATION_ATTEMPTS):
+            self._acquire()
+            try:
+                response = operation(**kwargs)
+            except ClientError as e:
+                throttled = e.response["Error"]["Code"] in THROTTLE_CODES
+                status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+                if (
+                    not (throttled or status >= 500)
+                    or attempt == MAX_MUTATION_ATTEMPTS - 1
+                ):
+                    raise
+                if throttled:
+                    # The bucket already spaces calls at the lowered rate; the jittered
+                    # backoff keeps workers that were throttled together from retrying
+                    # together
+                    self._throttled()
+                else:
+                    self._failed_transiently()
+            except TRANSIENT_ERRORS:
+                if attempt == MAX_MUTATION_ATTEMPTS - 1:
+                    raise
+                self._failed_transiently()
+            else:
+                self._succeeded()
+                return response
+            time.sleep(random.uniform(0, min(2**attempt, 30)))
+
+    def stats(self):
+        """Achieved ops/s, retry and throttle counts, and the current rate."""
+        with self.lock:
+            elapsed = 0.0
+            if self.started_at is not None and self.finished_at is not None:
+                elapsed = self.finished_at - self.started_at
+            return {
+                "ops": self.ops,
+                "ops_per_sec": self.ops / elapsed if elapsed else float(self.ops),
+                "retries": self.retries,
+                "throttles": self.throttles,
+                "rate": self.rate,
+            }
+
+    def print_summary(self):
+        stats = self.stats()
+        if stats["ops"] or stats["retries"]:
+            print(
+                f"⏱️  IAM writes: {stats['ops']} at {stats['ops_per_sec']:.1f} ops/s, "
+                f"{stats['retries']} retries ({stats['throttles']} throttled), "
+                f"limiter now at {stats['rate']:.1f} ops/s"
+            )
+
+
+mutation_limiter = MutationRateLimiter()
+
+
+def list_all_users(iam_client):
+    """List every IAM user, following pagination past the first 100."""
+    users = []
+    for page in iam_client.get_paginator("list_users").paginate():
+        users.extend(page["Users"])
+    return users
+
+
+def load_authorization_snapshot(iam_client):
+    """
+    Index users, groups and their policies from GetAccountAuthorizationDetails.
+
+    Returns a dict with:
+      users                 - user names, in the order IAM returned them
+      created               - user name -> CreateDate
+      user_policies         - user name -> [{"PolicyName", "PolicyArn"}] attached directly
+      group_policies        - group name -> set of managed policy ARNs attached to the group
+      group_inline_policies - group name -> set of the group's inline policy names
+      group_members         - group name -> set of user names in the group
+    """
+    snapshot = {
+        "users": [],
+        "created": {},
+        "user_policies": {},
+        "group_policies": {},
+        "group_inline_policies": {},
+        "group_members": {},
+    }
+    paginator = iam_client.get_paginator("get_account_authorization_details")
+
+    for page in paginator.paginate(Filter=["User", "Group"]):
+        for user in page.get("UserDetailList", []):
+            username = user["UserName"]
+            policies = [
+                {"PolicyName": p["PolicyName"], "PolicyArn": p["PolicyArn"]}
+                for p in user.get("AttachedManagedPolicies", [])
+            ]
+            snapshot["users"].append(username)
+            snapshot["created"][username] = user.get("CreateDate")
+            snapshot["user_policies"][username] = policies
+            for group_name in user.get("GroupList", []):
+                snapshot["group_members"].setdefault(group_name, set()).add(username)
+
+        for group in page.get("GroupDetailList", []):
+            snapshot["group_policies"].setdefault(group["GroupName"], set()).update(
+                p["PolicyArn"] for p in group.get("AttachedManagedPolicies", [])
+            )
+            snapshot["group_inline_policies"].setdefault(
+                group["GroupName"], set()
+            ).update(p["PolicyName"] for p in group.get("GroupPolicyList", []))
+            snapshot["group_members"].setdefault(group["GroupName"], set())
+
+    return snapshot
+
+
+def scan_snapshot(snapshot):
+    """Same result as scan_direct_policies, computed from a snapshot without API calls."""
+    return summarize_direct_policies(snapshot["users"], snapshot["user_policies"])
+
+
+def summarize_direct_policies(usernames, user_policies):
+    """
+    Turn user name -> attached policies into (users_with_direct_policies,
+    unique_policies), keeping the order of usernames. Users whose policies couldn't be
+    fetched (None) are left out.
+    """
+    users_with_direct_policies = []
+    unique_policies = set()
+
+    for username in usernames:
+        attached_policies = user_policies[username]
+        if attached_policies:
+            users_with_direct_policies.append(
+                {
+                    "username": username,
+                    "attached_policies": attached_policies,
+                }
+            )
+            for policy in attached_policies:
+                unique_policies.add(policy["PolicyName"])
+
+    return users_with_direct_policies, unique_policies
 
 
 def get_user_direct_policies(iam_client, username):
-    """Get directly attached policies for a user."""
+    """Get directly attached policies for a user, or None if they couldn't be fetched."""
     try:
-        attached_policies = iam_client.list_attached_user_policies(UserName=username)[
-            "AttachedPolicies"
-        ]
+        attached_policies = []
+        paginator = iam_client.get_paginator("list_attached_user_policies")
+        for page in paginator.paginate(UserName=username):
+            attached_policies.extend(page["AttachedPolicies"])
         return attached_policies
     except ClientError as e:
         print(f"❌ Error getting policies for user {username}: {e}")
-        return []
+        return None
 
 
 def sanitize_group_name(policy_name):
@@ -33,10 +305,24 @@ def sanitize_group_name(policy_name):
     return sanitized[:128]
 
 
+def suffixed_group_name(group_name, counter):
+    """group_name with a "-<counter>" suffix, still within the 128-character limit."""
+    suffix = f"-{counter}"
+    return group_name[: 128 - len(suffix)] + suffix
+
+
+def unused_group_name(group_name, existing_groups):
+    """Return group_name with the first "-N" suffix not in existing_groups."""
+    counter = 1
+    while suffixed_group_name(group_name, counter) in existing_groups:
+        counter += 1
+    return suffixed_group_name(group_name, counter)
+
+
 def create_iam_group(iam_client, group_name):
     """Create an IAM group."""
     try:
-        iam_client.create_group(GroupName=group_name)
+        mutation_limiter.call(iam_client.create_group, GroupName=group_name)
         print(f"✅ Created IAM group: {group_name}")
         return True
     except ClientError as e:
@@ -46,12 +332,17 @@ def create_iam_group(iam_client, group_name):
         else:
             print(f"❌ Error creating group {group_name}: {e}")
             return False
+    except BotoCoreError as e:
+        print(f"❌ Error creating group {group_name}: {e}")
+        return False
 
 
 def attach_policy_to_group(iam_client, group_name, policy_arn):
     """Attach a policy to an IAM group."""
     try:
-        iam_client.attach_group_policy(GroupName=group_name, PolicyArn=policy_arn)
+        mutation_limiter.call(
+            iam_client.attach_group_policy, GroupName=group_name, PolicyArn=policy_arn
+        )
         print(f"✅ Attached policy {policy_arn} to group {group_name}")
         return True
     except ClientError as e:
@@ -61,12 +352,17 @@ def attach_policy_to_group(iam_client, group_name, policy_arn):
         else:
             print(f"❌ Error attaching policy {policy_arn} to group {group_name}: {e}")
             return False
+    except BotoCoreError as e:
+        print(f"❌ Error attaching policy {policy_arn} to group {group_name}: {e}")
+        return False
 
 
 def add_user_to_group(iam_client, username, group_name):
     """Add a user to an IAM group."""
     try:
-        iam_client.add_user_to_group(GroupName=group_name, UserName=username)
+        mutation_limiter.call(
+            iam_client.add_user_to_group, GroupName=group_name, UserName=username
+        )
         print(f"✅ Added user {username} to group {group_name}")
         return True
     except ClientError as e:
@@ -76,15 +372,27 @@ def add_user_to_group(iam_client, username, group_name):
         else:
             print(f"❌ Error adding user {username} to group {group_name}: {e}")
             return False
+    except BotoCoreError as e:
+        print(f"❌ Error adding user {username} to group {group_name}: {e}")
+        return False
 
 
 def detach_policy_from_user(iam_client, username, policy_arn):
     """Detach a policy from a user."""
     try:
-        iam_client.detach_user_policy(UserName=username, PolicyArn=policy_arn)
+        mutation_limiter.call(
+            iam_client.detach_user_policy, UserName=username, PolicyArn=policy_arn
+        )
         print(f"✅ Detached policy {policy_arn} from user {username}")
         return True
     except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchEntity":
+            print(f"ℹ️  Policy {policy_arn} is not attached to user {username}")
+            return True
+        else:
+            print(f"❌ Error detaching policy {policy_arn} from user {username}: {e}")
+            return False
+    except BotoCoreError as e:
         print(f"❌ Error detaching policy {policy_arn} from user {username}: {e}")
         return False
 
@@ -92,8 +400,10 @@ def detach_policy_from_user(iam_client, username, policy_arn):
 def get_existing_groups(iam_client):
     """Get list of existing IAM groups."""
     try:
-        groups = iam_client.list_groups()["Groups"]
-        return {group["GroupName"] for group in groups}
+        groups = set()
+        for page in iam_client.get_paginator("list_groups").paginate():
+            groups.update(group["GroupName"] for group in page["Groups"])
+        return groups
     except ClientError as e:
         print(f"❌ Error listing IAM groups: {e}")
         return set()
@@ -118,10 +428,9 @@ def create_unique_groups(iam_client, unique_policies, existing_groups):
                 print(f"✅ Using existing group: {proposed_group_name}")
             else:
                 # Generate alternative name
-                counter = 1
-                while f"{proposed_group_name}-{counter}" in existing_groups:
-                    counter += 1
-                alternative_name = f"{proposed_group_name}-{counter}"
+                alternative_name = unused_group_name(
+                    proposed_group_name, existing_groups
+                )
                 if get_user_confirmation(
                     f"Create new group '{alternative_name}' for policy '{policy_name}'?"
                 ):
@@ -156,8 +465,15 @@ def get_user_confirmation(prompt):
             print("Please enter 'y' or 'n'")
 
 
-def process_user_policies_with_groups(iam_client, user_data, created_groups):
-    """Process policies for a single user using pre-created groups."""
+def process_user_policies_with_groups(
+    iam_client, user_data, created_groups, snapshot=None
+):
+    """
+    Process policies for a single user using pre-created groups.
+
+    With a snapshot, attachments and memberships it already records are not repeated,
+    and the snapshot is updated as changes are made.
+    """
     username = user_data["username"]
     attached_policies = user_data["attached_policies"]
 
@@ -181,9 +497,9 @@ def process_user_policies_with_groups(iam_client, user_data, created_groups):
         print(f"   Group: {group_name}")
 
         # Attach policy to group (if not already attached)
-        if attach_policy_to_group(iam_client, group_name, policy_arn):
+        if policy_attached_to_group(iam_client, group_name, policy_arn, snapshot):
             # Add user to group
-            if add_user_to_group(iam_client, username, group_name):
+            if user_in_group(iam_client, username, group_name, snapshot):
                 # Detach policy from user
                 if get_user_confirmation(
                     f"Remove direct policy attachment from user {username}?"
@@ -199,31 +515,529 @@ def process_user_policies_with_groups(iam_client, user_data, created_groups):
             print(f"❌ Failed to attach policy to group, skipping user addition")
 
 
-def audit_iam_users():
-    """Audit IAM users for directly attached policies."""
-    iam_client = boto3.client("iam")
+def policy_attached_to_group(iam_client, group_name, policy_arn, snapshot=None):
+    """Attach a policy to a group unless the snapshot shows it is already there."""
+    if snapshot is None:
+        return attach_policy_to_group(iam_client, group_name, policy_arn)
+
+    group_policies = snapshot["group_policies"].setdefault(group_name, set())
+    if policy_arn in group_policies:
+        print(f"ℹ️  Policy {policy_arn} already attached to group {group_name}")
+        return True
+    if attach_policy_to_group(iam_client, group_name, policy_arn):
+        group_policies.add(policy_arn)
+        return True
+    return False
+
+
+def user_in_group(iam_client, username, group_name, snapshot=None):
+    """Add a user to a group unless the snapshot shows they are already a member."""
+    if snapshot is None:
+        return add_user_to_group(iam_client, username, group_name)
+
+    members = snapshot["group_members"].setdefault(group_name, set())
+    if username in members:
+        print(f"ℹ️  User {username} already in group {group_name}")
+        return True
+    if add_user_to_group(iam_client, username, group_name):
+        members.add(username)
+        return True
+    return False
+
+
+def fetch_direct_policies(iam_client, usernames, workers=DEFAULT_WORKERS):
+    """Fetch attached policies for many users concurrently, as user name -> policies."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        all_policies = pool.map(
+            lambda username: get_user_direct_policies(iam_client, username), usernames
+        )
+        return dict(zip(usernames, all_policies))
+
+
+def scan_direct_policies(iam_client, users, workers=DEFAULT_WORKERS):
+    """
+    Fetch attached policies for many users concurrently.
+
+    Returns (users_with_direct_policies, unique_policies), with users in the same order
+    as the input.
+    """
+    usernames = [user["UserName"] for user in users]
+    user_policies = fetch_direct_policies(iam_client, usernames, workers)
+    return summarize_direct_policies(usernames, user_policies)
+
+
+def _timestamp(value):
+    return value.isoformat() if value else None
+
+
+def user_fingerprint(user):
+    """The list_users fields that tell the incremental audit a user may have changed."""
+    return {
+        "CreateDate": _timestamp(user.get("CreateDate")),
+        "PasswordLastUsed": _timestamp(user.get("PasswordLastUsed")),
+    }
+
+
+def load_state(path):
+    """Load the state saved by the previous audit, or None on the first run."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, audited_at, fingerprints, user_policies):
+    """
+    Save every user's fingerprint and direct attachments for the next audit.
+
+    Users whose policies couldn't be fetched are left out, so the next audit treats them
+    as new and fetches them again.
+    """
+    users = {
+        username: {**fingerprint, "attached_policies": user_policies[username]}
+        for username, fingerprint in fingerprints.items()
+        if user_policies.get(username) is not None
+    }
+    state = {"audited_at": audited_at.isoformat(), "users": users}
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+    print(f"💾 Saved IAM state for {len(users)} users to {path}")
+    if len(users) < len(fingerprints):
+        print(
+            f"⚠️  Left out {len(fingerprints) - len(users)} users whose policies "
+            f"couldn't be fetched; they will be re-fetched next time"
+        )
+
+
+def cloudtrail_policy_changes(since):
+    """
+    Users named in AttachUserPolicy/DetachUserPolicy events since a time.
+
+    Returns None when CloudTrail can't answer (history too old, or no access), in which
+    case every user has to be re-fetched.
+    """
+    if datetime.now(timezone.utc) - since > CLOUDTRAIL_RETENTION:
+        print("⚠️  Last audit is older than CloudTrail's event history")
+        return None
+
+    # IAM is a global service, so its events are recorded in us-east-1
+    cloudtrail = boto3.client("cloudtrail", region_name="us-east-1")
+    paginator = cloudtrail.get_paginator("lookup_events")
+    usernames = set()
 
     try:
-        users = iam_client.list_users()["Users"]
-        users_with_direct_policies = []
-        unique_policies = set()
+        for event_name in POLICY_CHANGE_EVENTS:
+            for page in paginator.paginate(
+                LookupAttributes=[
+                    {"AttributeKey": "EventName", "AttributeValue": event_name}
+                ],
+                StartTime=since - CLOUDTRAIL_DELIVERY_LAG,
+            ):
+                for event in page["Events"]:
+                    detail = json.loads(event.get("CloudTrailEvent") or "{}")
+                    username = (detail.get("requestParameters") or {}).get("userName")
+                    if username:
+                        usernames.add(username)
+    except (BotoCoreError, ClientError) as e:
+        print(f"⚠️  Could not look up CloudTrail events: {e}")
+        return None
 
-        print("🔍 Scanning IAM users for direct policy attachments...")
+    return usernames
 
-        for user in users:
-            username = user["UserName"]
-            attached_policies = get_user_direct_policies(iam_client, username)
-
-            if attached_policies:
-                users_with_direct_policies.append(
-                    {
-                        "username": username,
-                        "attached_policies": attached_policies,
-                    }
+
+def incremental_scan(iam_client, users, state, workers=DEFAULT_WORKERS):
+    """
+    Fetch attached policies only for users that may have changed since the last audit.
+
+    Everyone else keeps the attachments recorded in the state. Returns user name ->
+    attached policies for every user in users, None where the fetch failed.
+    """
+    previous = state["users"]
+    changed_in_trail = cloudtrail_policy_changes(
+        datetime.fromisoformat(state["audited_at"])
+    )
+    user_policies = {}
+    to_fetch = []
+
+    for user in users:
+        username = user["UserName"]
+        cached = previous.get(username)
+        if (
+            changed_in_trail is None
+            or cached is None
+            or username in changed_in_trail
+            or any(cached.get(k) != v for k, v in user_fingerprint(user).items())
+        ):
+            to_fetch.append(username)
+        else:
+            user_policies[username] = cached["attached_policies"]
+
+    print(
+        f"🔁 Re-fetching {len(to_fetch)} of {len(users)} users changed since "
+        f"{state['audited_at']}"
+    )
+    user_policies.update(fetch_direct_policies(iam_client, to_fetch, workers))
+    return user_policies
+
+
+def report_delta(state, user_policies):
+    """Print the direct attachments that appeared since the last audit."""
+    previous = state["users"]
+    new_attachments = []
+
+    for username, attached_policies in user_policies.items():
+        if attached_policies is None:
+            continue
+        known = {
+            policy["PolicyArn"]
+            for policy in previous.get(username, {}).get("attached_policies", [])
+        }
+        for policy in attached_policies:
+            if policy["PolicyArn"] not in known:
+                new_attachments.append((username, policy))
+
+    print(
+        f"\n📈 Since {state['audited_at']}: "
+        f"{len(new_attachments)} new direct policy attachments"
+    )
+    for username, policy in new_attachments:
+        print(f"  👤 {username}: {policy['PolicyName']} ({policy['PolicyArn']})")
+    return new_attachments
+
+
+def _groups_by_policy(
+    attached_policies, group_for_policy, existing_groups, known_policies
+):
+    """
+    One "<policy>-group" per policy ARN.
+
+    An existing group is only reused when known_policies (group name -> managed policy
+    ARNs, covering only groups without inline policies) shows it grants exactly that
+    policy. Otherwise the policy moves on to "<policy>-group-1", "-2" and so on until it
+    finds such a group or a name neither existing nor planned for another policy, so the
+    migration never hands users permissions they didn't have.
+    """
+    for policy in attached_policies:
+        policy_arn = policy["PolicyArn"]
+        if policy_arn not in group_for_policy:
+            planned = set(group_for_policy.values())
+            base_name = sanitize_group_name(f"{policy['PolicyName']}-group")
+            group_name, counter = base_name, 0
+            while group_name in planned or (
+                group_name in existing_groups
+                and known_policies.get(group_name) != {policy_arn}
+            ):
+                counter += 1
+                group_name = suffixed_group_name(base_name, counter)
+            group_for_policy[policy_arn] = group_name
+        yield group_for_policy[policy_arn], [policy_arn]
+
+
+def _groups_by_policy_set(attached_policies, reusable_groups, existing_groups):
+    """
+    Cover a user's exact set of policy ARNs with as few groups as possible.
+
+    Sets of up to MAX_POLICIES_PER_GROUP ARNs map to one group; larger sets are split into
+    sorted chunks. A chunk reuses an existing group that grants exactly those policies
+    (reusable_groups: ARN set -> group name), otherwise it gets a "policyset-<hash>" group,
+    so every user with the same set shares it. If that name is taken by a group granting
+    something else, the first free "policyset-<hash>-N" is used instead.
+    """
+    arns = sorted({policy["PolicyArn"] for policy in attached_policies})
+    for i in range(0, len(arns), MAX_POLICIES_PER_GROUP):
+        chunk = arns[i : i + MAX_POLICIES_PER_GROUP]
+        group_name = reusable_groups.get(frozenset(chunk))
+        if group_name is None:
+            digest = hashlib.sha1("\n".join(chunk).encode()).hexdigest()
+            group_name = f"policyset-{digest[:10]}"
+            if group_name in existing_groups:
+                group_name = unused_group_name(group_name, existing_groups)
+        yield group_name, chunk
+
+
+def _managed_only_groups(snapshot):
+    """
+    Group name -> managed policy ARNs, for the groups a plan may safely reuse.
+
+    Groups with inline policies are left out: the snapshot can't tell what those grant, so
+    adding a user to one could hand them permissions they never had.
+    """
+    return {
+        group_name: arns
+        for group_name, arns in snapshot["group_policies"].items()
+        if not snapshot["group_inline_policies"].get(group_name)
+    }
+
+
+def build_migration_plan(
+    users_with_direct_policies, existing_groups, snapshot=None, group_by="policy"
+):
+    """
+    Work out every change needed to move direct attachments onto groups.
+
+    group_by="policy" maps each policy ARN to a "<policy>-group" group, reusing an
+    existing one only if the snapshot shows it holds just that policy. group_by="policy-set"
+    gives every distinct set of policies its own group(s) instead, so each user joins the
+    fewest groups. Groups with inline policies are never reused. With a snapshot, attaches
+    and memberships that are already in place are left out.
+    """
+    group_for_policy = {}
+    reusable_groups = {}
+    if snapshot is not None and group_by == "policy-set":
+        for group_name, arns in sorted(_managed_only_groups(snapshot).items()):
+            if arns:
+                reusable_groups.setdefault(frozenset(arns), group_name)
+
+    steps = {phase: [] for phase in PLAN_PHASES}
+    seen = set()
+
+    def add_once(phase, step):
+        key = (phase, tuple(sorted(step.items())))
+        if key not in seen:
+            seen.add(key)
+            steps[phase].append(step)
+
+    for user_data in users_with_direct_policies:
+        username = user_data["username"]
+        attached_policies = user_data["attached_policies"]
+        if group_by == "policy-set":
+            assignments = _groups_by_policy_set(
+                attached_policies, reusable_groups, existing_groups
+            )
+        else:
+            assignments = _groups_by_policy(
+                attached_policies,
+                group_for_policy,
+                existing_groups,
+                _managed_only_groups(snapshot) if snapshot is not None else {},
+            )
+
+        for group_name, policy_arns in assignments:
+            if group_name not in existing_groups:
+                add_once("create_groups", {"group": group_name})
+
+            group_policies = ()
+            members = ()
+            if snapshot is not None:
+                group_policies = snapshot["group_policies"].get(group_name, ())
+                members = snapshot["group_members"].get(group_name, ())
+
+            for policy_arn in policy_arns:
+                if policy_arn not in group_policies:
+                    add_once(
+                        "attach_group_policies",
+                        {"group": group_name, "policy_arn": policy_arn},
+                    )
+                steps["detach_user_policies"].append(
+                    {"user": username, "policy_arn": policy_arn, "group": group_name}
                 )
-                # Collect unique policy names
-                for policy in attached_policies:
-                    unique_policies.add(policy["PolicyName"])
+
+            if username not in members:
+                add_once("add_memberships", {"group": group_name, "user": username})
+
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "group_by": group_by,
+        **steps,
+    }
+
+
+def write_plan(plan, path):
+    """Write a migration plan as JSON and print what it contains."""
+    with open(path, "w") as f:
+        json.dump(plan, f, indent=2)
+    print(f"\n📝 Wrote migration plan to {path}")
+    for phase in PLAN_PHASES:
+        print(f"   {phase}: {len(plan[phase])}")
+
+
+def _step_key(phase, step):
+    return json.dumps([phase, step], sort_keys=True)
+
+
+def _checkpoint_header(plan):
+    """First line of a plan's checkpoint: when the plan was generated and a hash of it."""
+    digest = hashlib.sha256(json.dumps(plan, sort_keys=True).encode()).hexdigest()
+    return f"# plan {plan['generated_at']} {digest[:16]}"
+
+
+def _load_checkpoint(path, header):
+    """
+    Return the step keys already completed according to a checkpoint file.
+
+    Returns None when the file was written for a different plan (its header doesn't match),
+    since its steps say nothing about this one.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        lines = [line.rstrip("\n") for line in f if line.strip()]
+    if not lines:
+        return set()
+    if lines[0] != header:
+        return None
+    return set(lines[1:])
+
+
+def _run_plan_step(iam_client, phase, step):
+    if phase == "create_groups":
+        return create_iam_group(iam_client, step["group"])
+    if phase == "attach_group_policies":
+        return attach_policy_to_group(iam_client, step["group"], step["policy_arn"])
+    if phase == "add_memberships":
+        return add_user_to_group(iam_client, step["user"], step["group"])
+    return detach_policy_from_user(iam_client, step["user"], step["policy_arn"])
+
+
+def _detach_prerequisites(step):
+    return (
+        _step_key(
+            "attach_group_policies",
+            {"group": step["group"], "policy_arn": step["policy_arn"]},
+        ),
+        _step_key("add_memberships", {"group": step["group"], "user": step["user"]}),
+    )
+
+
+def apply_migration_plan(iam_client, plan, checkpoint_path, workers=DEFAULT_WORKERS):
+    """
+    Execute a migration plan without prompting.
+
+    Steps run in parallel within each phase. Completed steps are appended to the
+    checkpoint file and skipped on the next run. The checkpoint starts with the plan's
+    generated_at and hash, and one written for another plan is refused rather than
+    resumed. A detach is skipped unless its group attach and membership either succeeded
+    or were never needed.
+    """
+    header = _checkpoint_header(plan)
+    done = _load_checkpoint(checkpoint_path, header)
+    if done is None:
+        print(
+            f"❌ {checkpoint_path} belongs to a different plan; remove it or pass "
+            f"another --checkpoint"
+        )
+        return None
+    planned = {_step_key(phase, step) for phase in PLAN_PHASES for step in plan[phase]}
+    lock = threading.Lock()
+    totals = {"applied": 0, "resumed": 0, "failed": 0, "blocked": 0}
+
+    if done:
+        print(f"🔁 Resuming from {checkpoint_path}: {len(done)} steps already done")
+
+    with open(checkpoint_path, "a") as checkpoint, ThreadPoolExecutor(
+        max_workers=workers
+    ) as pool:
+        if not done:
+            # Fresh (or empty) checkpoint: start it with this plan's identity
+            checkpoint.truncate(0)
+            checkpoint.write(header + "\n")
+            checkpoint.flush()
+
+        def run(phase, step):
+            key = _step_key(phase, step)
+            if key in done:
+                with lock:
+                    totals["resumed"] += 1
+                return
+            if phase == "detach_user_policies" and any(
+                prerequisite in planned and prerequisite not in done
+                for prerequisite in _detach_prerequisites(step)
+            ):
+                print(
+                    f"⚠️  Keeping {step['policy_arn']} on {step['user']}: "
+                    f"group {step['group']} was not set up"
+                )
+                with lock:
+                    totals["blocked"] += 1
+                return
+            ok = _run_plan_step(iam_client, phase, step)
+            with lock:
+                if ok:
+                    done.add(key)
+                    checkpoint.write(key + "\n")
+                    checkpoint.flush()
+                    totals["applied"] += 1
+                else:
+                    totals["failed"] += 1
+
+        for phase in PLAN_PHASES:
+            if plan[phase]:
+                print(f"\n🚀 {phase}: {len(plan[phase])} steps")
+            list(pool.map(lambda step: run(phase, step), plan[phase]))
+
+    print(
+        f"\n📊 Applied {totals['applied']}, resumed {totals['resumed']}, "
+        f"failed {totals['failed']}, blocked {totals['blocked']}"
+    )
+    mutation_limiter.print_summary()
+    return totals
+
+
+def audit_iam_users(
+    workers=DEFAULT_WORKERS,
+    use_snapshot=False,
+    plan_path=None,
+    group_by="policy",
+    state_path=None,
+):
+    """
+    Audit IAM users for directly attached policies.
+
+    With plan_path, the migration is written to that file instead of being run
+    interactively, grouping users as group_by says. With state_path, only users that
+    changed since the saved state are re-fetched and the new attachments are reported.
+    """
+    iam_client = make_iam_client(workers)
+    snapshot = None
+    state = load_state(state_path) if state_path else None
+    audited_at = datetime.now(timezone.utc)
+
+    try:
+        if use_snapshot:
+            print("🔍 Loading account authorization details...")
+            snapshot = load_authorization_snapshot(iam_client)
+            print(
+                f"🔍 Indexed {len(snapshot['users'])} users and "
+                f"{len(snapshot['group_policies'])} groups"
+            )
+            usernames = snapshot["users"]
+            user_policies = snapshot["user_policies"]
+            # The authorization details don't include PasswordLastUsed, so keep the
+            # last known value rather than forcing a re-fetch next time
+            previous = state["users"] if state else {}
+            fingerprints = {
+                username: {
+                    "CreateDate": _timestamp(snapshot["created"][username]),
+                    "PasswordLastUsed": previous.get(username, {}).get(
+                        "PasswordLastUsed"
+                    ),
+                }
+                for username in usernames
+            }
+        else:
+            users = list_all_users(iam_client)
+
+            print(
+                f"🔍 Scanning {len(users)} IAM users for direct policy attachments..."
+            )
+
+            usernames = [user["UserName"] for user in users]
+            if state:
+                user_policies = incremental_scan(iam_client, users, state, workers)
+            else:
+                user_policies = fetch_direct_policies(iam_client, usernames, workers)
+            fingerprints = {user["UserName"]: user_fingerprint(user) for user in users}
+
+        users_with_direct_policies, unique_policies = summarize_direct_policies(
+            usernames, user_policies
+        )
+
+        if state:
+            report_delta(state, user_policies)
+        if state_path:
+            save_state(state_path, audited_at, fingerprints, user_policies)
 
         if users_with_direct_policies:
             print("\n⚠️  Users with directly attached policies:")
@@ -240,24 +1054,38 @@ def audit_iam_users():
             print(f"📋 Unique policies to process: {len(unique_policies)}")
             print("Unique policies:", ", ".join(sorted(unique_policies)))
 
-            if get_user_confirmation(
+            if plan_path:
+                if snapshot is not None:
+                    existing_groups = set(snapshot["group_policies"])
+                else:
+                    existing_groups = get_existing_groups(iam_client)
+                plan = build_migration_plan(
+                    users_with_direct_policies, existing_groups, snapshot, group_by
+                )
+                write_plan(plan, plan_path)
+            elif get_user_confirmation(
                 "Would you like to process these users and create IAM groups?"
             ):
                 print("\n🚀 Starting interactive policy migration...")
                 # First, check for existing groups and create unique groups
-                existing_groups = get_existing_groups(iam_client)
+                if snapshot is not None:
+                    existing_groups = set(snapshot["group_policies"])
+                else:
+                    existing_groups = get_existing_groups(iam_client)
+                mutation_client = make_iam_client(workers, mutations=True)
                 created_groups = create_unique_groups(
-                    iam_client, unique_policies, existing_groups
+                    mutation_client, unique_policies, existing_groups
                 )
 
                 # Then process each user
                 for user_data in users_with_direct_policies:
                     process_user_policies_with_groups(
-                        iam_client, user_data, created_groups
+                        mutation_client, user_data, created_groups, snapshot
                     )
                     print("\n" + "=" * 60 + "\n")
 
                 print("✅ Policy migration process completed!")
+                mutation_limiter.print_summary()
             else:
                 print("⏭️  Skipped policy migration")
         else:
@@ -267,5 +1095,80 @@ def audit_iam_users():
         print(f"❌ Error listing IAM users: {e}")
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Audit IAM users for directly attached policies."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="Users whose policies are fetched in parallel",
+    )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        help="Audit from one GetAccountAuthorizationDetails pull instead of per-user calls",
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--plan",
+        metavar="FILE",
+        help="Write the migration to a JSON plan instead of prompting",
+    )
+    mode.add_argument(
+        "--apply",
+        metavar="FILE",
+        help="Apply a plan written by --plan without prompting",
+    )
+    parser.add_argument(
+        "--group-by",
+        choices=GROUPING_MODES,
+        default="policy",
+        help="Plan one group per policy, or one per distinct set of policies",
+    )
+    parser.add_argument(
+        "--mutation-rate",
+        type=float,
+        default=MUTATION_RATE,
+        help="IAM writes per second to start at before adapting",
+    )
+    parser.add_argument(
+        "--max-mutation-rate",
+        type=float,
+        default=MAX_MUTATION_RATE,
+        help="Ceiling for the adaptive IAM write rate",
+    )
+    parser.add_argument(
+        "--state",
+        metavar="FILE",
+        help="Keep IAM state here and only re-fetch users changed since the last run",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        metavar="FILE",
+        help="Record applied steps here to resume (default: <plan>.checkpoint)",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    audit_iam_users()
+    args = parse_args()
+    mutation_limiter.configure(args.mutation_rate, args.max_mutation_rate)
+    if args.apply:
+        with open(args.apply) as f:
+            plan = json.load(f)
+        apply_migration_plan(
+            make_iam_client(args.workers, mutations=True),
+            plan,
+            args.checkpoint or f"{args.apply}.checkpoint",
+            args.workers,
+        )
+    else:
+        audit_iam_users(
+            workers=args.workers,
+            use_snapshot=args.snapshot,
+            plan_path=args.plan,
+            group_by=args.group_by,
+            state_path=args.state,
+        )
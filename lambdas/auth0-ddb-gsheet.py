@@ -3,15 +3,27 @@ This lambda function is used to process Auth0 logs from DynamoDB and send a repo
 """
 
 
+import base64
+import hashlib
+import json
 import logging
+import math
+import queue
+import random
+import threading
+import uuid
 import boto3
 import time
 
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from decimal import Decimal
 
 
@@ -22,6 +34,38 @@ DYNAMODB_TABLE_NAME = 'DDBTableName'  # This is the name of the DynamoDB table y
 SPREADSHEET_ID      = 'GoogleSheetID'  # This is the ID of the Google Sheet you want to use, you MUST change this!
 EXCLUDED_DOMAINS    = ['test.com']  # Optional, if you want to exclude certain domains from the report, add them here.
 TIMEOUT_SECONDS     = 900  # 15 minutes, max for Lambda, adjust as needed
+MAX_PARTITION_WORKERS = 8  # Days queried in parallel, keep under the table's read capacity
+MAX_RETRIES         = 10  # Per page, on throttling
+SCAN_SEGMENTS       = 16  # Parallel scan segments when reading the whole table
+MAX_PENDING_PAGES   = 16  # Pages read ahead of the aggregator before partition workers wait
+THROTTLE_CODES      = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+LOG_TYPES           = ['f', 's', 'scp', 'fcpr']  # See https://auth0.com/docs/deploy-monitor/logs/log-event-type-codes
+LOG_TYPE_INDEX_NAME = None  # Optional GSI keyed on day + LOG_TYPE_ATTRIBUTE, so other event types are never read
+LOG_TYPE_ATTRIBUTE  = 'log_type'  # Top-level copy of data.type the GSI sorts on (index keys can't be nested)
+# The GSI must also project 'data' (INCLUDE or ALL); PROJECTION reads data.user_name and data.type from it.
+ROLLUP_BUCKET       = None  # Optional S3 bucket for per-day aggregates, so each day is only read from DynamoDB once
+ROLLUP_PREFIX       = 'auth0-rollups/'
+ROLLUP_SETTLE_HOURS = 2  # A day is only rolled up this long after it ends, once late logs have landed
+APPROXIMATE_ERROR   = 0.02  # Relative error of the HyperLogLog sketches saved in rollups (and the default for approximate mode)
+CHECKPOINT_BUCKET   = None  # Optional S3 bucket for resumable runs; long ranges continue in a new invocation
+# With ROLLUP_BUCKET also set, finished days are rolled up and only the unfinished ones are checkpointed.
+CHECKPOINT_PREFIX   = 'auth0-checkpoints/'
+CHECKPOINT_MARGIN_SECONDS = 60  # Checkpoint once this little time is left in the invocation (at most a quarter of it)
+MAX_CHECKPOINT_HOPS = 50  # Invocations one report may continue across before it gives up
+SHEETS_ROWS_PER_REQUEST = 2000  # Rows per updateCells request
+SHEETS_REQUESTS_PER_BATCH = 5  # Requests per batchUpdate call, keeps each call under ~2 MB
+
+# Only the fields the report uses. 'data' and 'type' are DynamoDB reserved words.
+PROJECTION = {
+    'ProjectionExpression': '#data.#user_name, #data.#type',
+    'ExpressionAttributeNames': {'#data': 'data', '#user_name': 'user_name', '#type': 'type'},
+}
+
+# boto3 resources aren't thread-safe, so each partition worker gets its own Table.
+_thread_local = threading.local()
+
+# Authorized Sheets client, kept across warm invocations
+_sheets_service = None
 
 
 def lambda_handler(event, context):
@@ -31,7 +75,29 @@ def lambda_handler(event, context):
     end_date_str = event.get('end_date', None)
     sheet = event.get('sheet', 'TEMPSHEET')
     watched_domains = event.get('watched_domains', [])
+    # Set to e.g. 0.02 to estimate large domains' active accounts within ~2% instead of holding
+    # their addresses; watched domains and domains under HyperLogLog.small_limit() stay exact
+    approximate_error = event.get('approximate_error', None)
     unique_addresses_only = bool(event.get('unique_addresses_only', False))
+    # Read the whole table with a parallel scan instead of a date range, optionally split
+    # across `fan_out` child invocations of this function
+    full_scan = bool(event.get('full_scan', False))
+    fan_out = int(event.get('fan_out', 0))
+
+    # A child of a fan-out scan: reduce its segments and hand the partial aggregate back
+    if 'scan_segments' in event:
+        counter = UserCounter(watched_domains, approximate_error)
+        for _, page, _ in iter_segment_pages(event['scan_segments'], event['total_segments']):
+            counter.add_page(page)
+        return {
+            'statusCode': 200,
+            'body': counter.to_dict(with_sketches=False)
+        }
+
+    if full_scan:
+        # Only used to label the report
+        start_date_str = start_date_str or 'first log'
+        end_date_str = end_date_str or 'last log'
 
     # Get some context for a default range in case it's needed, cheap to find.
     first_day_current_month = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
@@ -46,9 +112,12 @@ def lambda_handler(event, context):
         # Set end_date to last day of last month
         end_date_str = last_day_last_month.strftime('%Y-%m-%d')
 
-    # Get logs from DynamoDB
+    # Stream logs from DynamoDB, aggregating each page as it arrives
     logger.info(f'Getting logs from {start_date_str} to {end_date_str}')
-    logs = get_logs(start_date_str, end_date_str)
+    if full_scan:
+        logs = (log for page in iter_log_pages() for log in page)
+    else:
+        logs = (log for page in iter_log_pages(start_date_str, end_date_str) for log in page)
 
     # Used for pulling a list of unique email addresses
     if unique_addresses_only:
@@ -69,9 +138,32 @@ def lambda_handler(event, context):
 
     logger.info('Counting users...')
     # Unpack all return values from count_users
+    if full_scan and fan_out:
+        counts = count_users_fan_out(context.function_name, fan_out, watched_domains, approximate_error)
+    elif (ROLLUP_BUCKET or CHECKPOINT_BUCKET and context is not None) and not full_scan:
+        if ROLLUP_BUCKET:
+            # Without CHECKPOINT_BUCKET there is nowhere to checkpoint, so no deadline
+            deadline = None
+            if CHECKPOINT_BUCKET and context is not None:
+                deadline = checkpoint_deadline(context)
+            counts, continuation_token = count_users_with_rollups(
+                start_date_str, end_date_str, watched_domains, approximate_error,
+                deadline, event.get('continuation_token'))
+        else:
+            counts, continuation_token = count_users_resumable(
+                event, context, start_date_str, end_date_str, watched_domains, approximate_error)
+        if continuation_token:
+            return continue_later(event, context, start_date_str, end_date_str, continuation_token)
+        if counts is None:
+            return {
+                'statusCode': 409,
+                'body': f"Checkpoint {event['continuation_token']} was already used"
+            }
+    else:
+        counts = count_users(logs, watched_domains, approximate_error)
     (total_users, users_by_domain, successful_logins, successful_logins_by_domain,
      failed_logins, failed_logins_by_domain, password_changes, password_changes_by_domain,
-     users_by_watched_domain) = count_users(logs, watched_domains)
+     users_by_watched_domain) = counts
 
     if sheet is not None:
         # Send results to Google Sheets
@@ -128,63 +220,235 @@ def daterange(start_date, end_date):
         yield start_date + timedelta(n)
 
 
-def get_logs(start_date=None, end_date=None):
+def _table():
+    if not hasattr(_thread_local, 'table'):
+        _thread_local.table = boto3.session.Session().resource('dynamodb').Table(DYNAMODB_TABLE_NAME)
+    return _thread_local.table
+
+
+class ThrottleBackoff:
     """
-    Get logs from DynamoDB table.
+    Backoff shared by all partition workers. When one worker is throttled every worker
+    pauses until the backoff passes, instead of each one hammering the table on its own.
+    Setting stop cuts every pause short.
     """
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-    start_time = time.time()
 
-    logs = []
-
-    # If start_date and end_date are provided, query logs based on these dates
-    if start_date and end_date:
-        for single_date in daterange(start_date, end_date):
-            for i in range(10):  # Maximum of 10 retries
-                try:
-                    response = table.query(
-                        KeyConditionExpression=Key('day').eq(single_date.strftime("%Y-%m-%d"))
-                    )
-                    for item in response['Items']:
-                            if item['data']['type'] in ['f', 's', 'scp', 'fcpr']:
-                                logs.append(item)
-
-                    while 'LastEvaluatedKey' in response:
-                        # logger.info(f'Querying page... LEK: {response["LastEvaluatedKey"]}')
-                        response = table.query(
-                            KeyConditionExpression=Key('day').eq(single_date.strftime("%Y-%m-%d")),
-                            ExclusiveStartKey=response['LastEvaluatedKey']
-                        )
-
-                        # Don't evaluate logs we're not interested in,
-                        # see https://auth0.com/docs/deploy-monitor/logs/log-event-type-codes for more details.
-                        for item in response['Items']:
-                            if item['data']['type'] in ['f', 's', 'scp', 'fcpr']:
-                                logs.append(item)
-
-                        # Check for timeout
-                        if time.time() - start_time > TIMEOUT_SECONDS:
-                            raise TimeoutError(f'Query took too long on {single_date.strftime("%Y-%m-%d")}!')
+    def __init__(self, stop=None):
+        self.lock = threading.Lock()
+        self.resume_at = 0.0
+        self.stop = stop or threading.Event()
 
-                    break
+    def wait(self):
+        """Sleep out the backoff; returns False if stop was set and the read should be abandoned."""
+        delay = self.resume_at - time.time()
+        if delay > 0:
+            self.stop.wait(delay)
+        return not self.stop.is_set()
+
+    def throttled(self, attempt):
+        with self.lock:
+            self.resume_at = max(self.resume_at, time.time() + 2 ** attempt * random.uniform(0.5, 1.0))
 
-                except ClientError as e:
-                    if e.response['Error']['Code'] == 'ProvisionedThroughputExceededException':
-                        time.sleep(2 ** i)  # Exponential backoff
-                    else:
-                        raise
+
+def _day_queries(day):
+    """
+    Query arguments that together return a day's LOG_TYPES events. Against the table the
+    type is filtered server-side, which still costs reads for the skipped items; against
+    the GSI only the wanted (day, type) ranges are read.
+    """
+    if LOG_TYPE_INDEX_NAME:
+        for log_type in LOG_TYPES:
+            yield {
+                'IndexName': LOG_TYPE_INDEX_NAME,
+                'KeyConditionExpression': Key('day').eq(day) & Key(LOG_TYPE_ATTRIBUTE).eq(log_type),
+                **PROJECTION,
+            }
     else:
-        # If start_date and end_date are not provided, scan entire table
-        response = table.scan()
-        logs = response['Items']
+        yield {
+            'KeyConditionExpression': Key('day').eq(day),
+            'FilterExpression': Attr('data.type').is_in(LOG_TYPES),
+            **PROJECTION,
+        }
+
+
+def query_day(day, backoff, start_time, cursor=None):
+    """
+    Query a single day partition page by page, retrying only the page that was throttled.
+
+    Yields (items, cursor) per page, where cursor resumes the day right after that page
+    and is None once the day is finished.
+    """
+    queries = list(_day_queries(day))
+    first = cursor or {'query': 0, 'key': None}
+    for index in range(first['query'], len(queries)):
+        start_key = first['key'] if index == first['query'] else None
+        for items, next_key in _read_pages('query', day, queries[index], backoff, start_time, start_key):
+            if next_key is not None:
+                yield items, {'query': index, 'key': next_key}
+            elif index + 1 < len(queries):
+                yield items, {'query': index + 1, 'key': None}
+            else:
+                yield items, None
+
+
+def scan_segment(segment, total_segments, backoff, start_time, cursor=None):
+    """
+    Scan one segment of the whole table with the same type filter and projection as the
+    day queries. Yields (items, cursor) like query_day.
+    """
+    kwargs = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'FilterExpression': Attr('data.type').is_in(LOG_TYPES),
+        **PROJECTION,
+    }
+    start_key = cursor['key'] if cursor else None
+    label = f'segment {segment}/{total_segments}'
+    for items, next_key in _read_pages('scan', label, kwargs, backoff, start_time, start_key):
+        yield items, ({'query': 0, 'key': next_key} if next_key is not None else None)
+
+
+def _read_pages(operation, label, kwargs, backoff, start_time, start_key=None):
+    """Yield (items, LastEvaluatedKey) per page; the key is None on the last page."""
+    table = _table()
+    read = getattr(table, operation)
+    # boto3 adds the condition's placeholders to ExpressionAttributeNames in place, so
+    # don't hand it the shared PROJECTION dict
+    kwargs = dict(kwargs, ExpressionAttributeNames=dict(kwargs['ExpressionAttributeNames']))
+    if start_key:
+        kwargs['ExclusiveStartKey'] = start_key
+
+    while True:
+        for attempt in range(MAX_RETRIES):
+            if not backoff.wait():
+                return
+            try:
+                response = read(**kwargs)
+                break
+            except ClientError as e:
+                if e.response['Error']['Code'] in THROTTLE_CODES and attempt < MAX_RETRIES - 1:
+                    backoff.throttled(attempt)
+                else:
+                    raise
+
+        yield response['Items'], response.get('LastEvaluatedKey')
+
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        # Check for timeout
+        if time.time() - start_time > TIMEOUT_SECONDS:
+            raise TimeoutError(f'Query took too long on {label}!')
+
+
+_PART_DONE = object()
+
+
+def iter_log_pages(start_date=None, end_date=None):
+    """
+    Yield pages (lists of items) of logs from DynamoDB table, as they arrive.
+
+    With a date range, days are read concurrently by iter_day_pages and pages from
+    different days interleave.
+    """
+    # If start_date and end_date are not provided, scan entire table
+    if not (start_date and end_date):
+        for _, page, _ in iter_segment_pages(range(SCAN_SEGMENTS), SCAN_SEGMENTS):
+            yield page
+        return
+
+    for _, page, _ in iter_day_pages(days_between(start_date, end_date)):
+        yield page
+
+
+def days_between(start_date, end_date):
+    return [single_date.strftime("%Y-%m-%d") for single_date in daterange(start_date, end_date)]
+
+
+def iter_day_pages(days, cursors=None, deadline=None):
+    """
+    Yield (day, page, cursor) for the given day partitions as pages arrive, resuming
+    each day from cursors[day] if given. See query_day for cursors, and
+    _iter_parallel_pages for deadline.
+    """
+    return _iter_parallel_pages(days, query_day, cursors, deadline)
+
 
-        # If there are more items than can be returned in a single scan, continue scanning until all items are returned
-        while 'LastEvaluatedKey' in response:
-            response = table.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-            logs.extend(response['Items'])
+def iter_segment_pages(segments, total_segments):
+    """
+    Yield (segment, page, cursor) for the given parallel scan segments as pages arrive.
+    """
+    return _iter_parallel_pages(
+        list(segments),
+        lambda segment, backoff, start_time, cursor: scan_segment(segment, total_segments, backoff, start_time, cursor)
+    )
 
-    return logs
+
+def _iter_parallel_pages(parts, read_part, cursors=None, deadline=None):
+    """
+    Yield (part, page, cursor) from read_part(part, backoff, start_time, cursor) run for
+    each part on a thread pool, stopping early once deadline (a time.time() value) passes.
+    """
+    cursors = cursors or {}
+    if not parts:
+        return
+    start_time = time.time()
+    stop = threading.Event()
+    backoff = ThrottleBackoff(stop)
+    pages = queue.Queue(maxsize=MAX_PENDING_PAGES)
+
+    def put(page):
+        # Give up if the consumer has gone away, rather than blocking the pool forever
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def read(part):
+        # Parts still queued when the consumer stops are skipped, not read and thrown away
+        if stop.is_set():
+            return
+        try:
+            for page, cursor in read_part(part, backoff, start_time, cursors.get(part)):
+                if stop.is_set():
+                    return
+                put((part, page, cursor))
+            put(_PART_DONE)
+        except Exception as e:
+            put(e)
+
+    pool = ThreadPoolExecutor(max_workers=min(MAX_PARTITION_WORKERS, len(parts)))
+    try:
+        for part in parts:
+            pool.submit(read, part)
+        remaining = len(parts)
+        while remaining:
+            if deadline is not None and time.time() >= deadline:
+                logger.info('Stopping reads at the deadline')
+                return
+            try:
+                page = pages.get(timeout=1)
+            except queue.Empty:
+                continue
+            if page is _PART_DONE:
+                remaining -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield page
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_logs(start_date=None, end_date=None):
+    """
+    Get logs from DynamoDB table as one list. Prefer iter_log_pages for large ranges.
+    """
+    return [item for page in iter_log_pages(start_date, end_date) for item in page]
 
 
 def get_unique_addresses(logs):
@@ -210,74 +474,611 @@ def get_unique_addresses(logs):
     return list(unique_addresses)
 
 
-def count_users(logs, watched_domains):
-    unique_users = set()
-    unique_users_by_domain = {}
-    users_by_domain = {}
-    successful_logins = 0
-    failed_logins = 0
-    password_changes = 0
-    successful_logins_by_domain = {}
-    failed_logins_by_domain = {}
-    password_changes_by_domain = {}
+class HyperLogLog:
+    """
+    Mergeable cardinality sketch: 2**precision one-byte registers over a 64-bit SHA-1 hash,
+    with a standard error of about 1.04 / sqrt(2**precision).
 
-    for log in logs:
+    A sketch starts sparse, keeping only the registers that have been set in a dict, and
+    switches to the dense bytearray once more than 1/64 of them are set, which is about
+    where the dict stops being the smaller of the two. to_dict() writes the sparse form
+    while no more than a quarter of the registers are set, so small domains stay small
+    in rollups.
+    """
+
+    def __init__(self, precision):
+        self.precision = precision
+        self.sparse = {}  # register index -> rank, until the sketch goes dense
+        self.registers = None
+
+    @staticmethod
+    def precision_for(error):
+        """
+        Smallest precision whose standard error is within error. Precision tops out at 16
+        (about 0.41%), so smaller errors get that instead.
+        """
+        if error < 1.04 / 256:
+            logger.warning(f'approximate_error {error} is below the HyperLogLog floor of {1.04 / 256:.4f}, using that')
+        return min(16, max(4, math.ceil(math.log2((1.04 / error) ** 2))))
+
+    @staticmethod
+    def small_limit(precision):
+        """Up to this many values (or set registers), exact or sparse storage beats the dense registers."""
+        return (1 << precision) // 4
+
+    def _raise(self, index, rank):
+        if self.registers is not None:
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            if len(self.sparse) > (1 << self.precision) // 64:
+                self._densify()
+
+    def _densify(self):
+        self.registers = bytearray(1 << self.precision)
+        for index, rank in self.sparse.items():
+            self.registers[index] = rank
+        self.sparse = None
+
+    def add(self, value):
+        x = int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], 'big')
+        bits = 64 - self.precision
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        self._raise(x >> bits, rank)
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(f'Cannot merge HyperLogLog precision {other.precision} into {self.precision}')
+        if other.registers is None:
+            for index, rank in other.sparse.items():
+                self._raise(index, rank)
+        else:
+            if self.registers is None:
+                self._densify()
+            self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = 1 << self.precision
+        if self.registers is None:
+            zeros = m - len(self.sparse)
+            harmonic = zeros + sum(2.0 ** -rank for rank in self.sparse.values())
+        else:
+            zeros = self.registers.count(0)
+            harmonic = sum(2.0 ** -register for register in self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / harmonic
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate while most registers are still empty
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        m = 1 << self.precision
+        if self.registers is None:
+            nonzero = sorted(self.sparse.items())
+        elif m - self.registers.count(0) <= HyperLogLog.small_limit(self.precision):
+            nonzero = [(index, rank) for index, rank in enumerate(self.registers) if rank]
+        else:
+            return {'precision': self.precision, 'registers': base64.b64encode(bytes(self.registers)).decode()}
+        # Three bytes per set register: big-endian index (precision is at most 16), then rank
+        packed = b''.join(index.to_bytes(2, 'big') + bytes([rank]) for index, rank in nonzero)
+        return {'precision': self.precision, 'sparse': base64.b64encode(packed).decode()}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['precision'])
+        if 'registers' in data:
+            sketch.sparse = None
+            sketch.registers = bytearray(base64.b64decode(data['registers']))
+        else:
+            packed = base64.b64decode(data['sparse'])
+            for offset in range(0, len(packed), 3):
+                sketch._raise(int.from_bytes(packed[offset:offset + 2], 'big'), packed[offset + 2])
+        return sketch
+
+
+class UserCounter:
+    """
+    Incremental version of count_users: add() log items as they arrive, then result().
+
+    Memory grows with the number of distinct users, not the number of events. Counters
+    from separate readers or days can be combined with merge(), and saved with to_dict().
+    Events are counted per user for every domain, so which domains are watched only
+    matters when result() is called.
+
+    With approximate_error, a domain's users are still counted exactly until there are
+    more of them than HyperLogLog.small_limit(), when they're folded into a HyperLogLog
+    sketch and only watched_domains keep their per-user counts. Most domains are small,
+    so they never pay for a sketch.
+    """
+
+    def __init__(self, watched_domains=(), approximate_error=None):
+        self.watched_domains = set(watched_domains)
+        self.precision = HyperLogLog.precision_for(approximate_error) if approximate_error else None
+        self.emails_by_domain = {}
+        self.sketches_by_domain = {}
+        self.successful_logins_by_domain = {}
+        self.failed_logins_by_domain = {}
+        self.password_changes_by_domain = {}
+
+    def _sketch(self, domain):
+        """The domain's sketch, folding its exact emails into a new one on first use."""
+        if domain not in self.sketches_by_domain:
+            sketch = HyperLogLog(self.precision)
+            emails = self.emails_by_domain.get(domain, {})
+            sketch.update(emails)
+            if domain not in self.watched_domains:
+                self.emails_by_domain.pop(domain, None)
+            self.sketches_by_domain[domain] = sketch
+        return self.sketches_by_domain[domain]
+
+    def _add_email(self, domain, user_email, count):
+        sketch = self.sketches_by_domain.get(domain)
+        if sketch is not None:
+            sketch.add(user_email)
+            if domain not in self.watched_domains:
+                return
+        emails = self.emails_by_domain.setdefault(domain, {})
+        emails[user_email] = emails.get(user_email, 0) + count
+        if (sketch is None and self.precision is not None and domain not in self.watched_domains
+                and len(emails) > HyperLogLog.small_limit(self.precision)):
+            self._sketch(domain)
+
+    def add(self, log):
         try:
             user_email = log['data']['user_name']
             log_type = log['data']['type']
         except KeyError:
-            continue
+            return
 
         if '@' not in user_email or user_email.endswith('@'):
-            continue
+            return
 
         domain = user_email.split('@')[-1]
 
         if domain in EXCLUDED_DOMAINS:
-            continue
+            return
 
-        unique_users.add(user_email)
-        if domain not in unique_users_by_domain:
-            unique_users_by_domain[domain] = set()
-        unique_users_by_domain[domain].add(user_email)
-
-        if domain in watched_domains:
-            if domain not in users_by_domain:
-                users_by_domain[domain] = {'emails': {}}
-            users_by_domain[domain]['emails'][user_email] = users_by_domain[domain]['emails'].get(user_email, 0) + 1
+        self._add_email(domain, user_email, 1)
 
         if log_type == 's':
-            successful_logins += 1
-            successful_logins_by_domain[domain] = successful_logins_by_domain.get(domain, 0) + 1
+            counts = self.successful_logins_by_domain
         elif log_type == 'f':
-            failed_logins += 1
-            failed_logins_by_domain[domain] = failed_logins_by_domain.get(domain, 0) + 1
+            counts = self.failed_logins_by_domain
         elif log_type in ['scp', 'fcpr']:
-            password_changes += 1
-            password_changes_by_domain[domain] = password_changes_by_domain.get(domain, 0) + 1
+            counts = self.password_changes_by_domain
+        else:
+            return
+        counts[domain] = counts.get(domain, 0) + 1
 
-    total_users = len(unique_users)
-    unique_users_by_domain = {domain: len(users) for domain, users in unique_users_by_domain.items()}
-    users_by_domain = {domain: {'emails': data['emails']} for domain, data in users_by_domain.items()}
+    def add_page(self, logs):
+        for log in logs:
+            self.add(log)
 
-    return (total_users, unique_users_by_domain, successful_logins, successful_logins_by_domain,
-            failed_logins, failed_logins_by_domain, password_changes, password_changes_by_domain, users_by_domain)
+    def _counters(self):
+        return (self.successful_logins_by_domain, self.failed_logins_by_domain, self.password_changes_by_domain)
 
+    def merge(self, other):
+        """
+        Fold another counter's results into this one. An exact counter can be merged into
+        an approximate one, not the other way round. A sketch of the same precision is
+        merged register by register; otherwise the other counter's emails are added one by one.
+        """
+        if self.precision is None and other.precision is not None:
+            raise ValueError('Cannot merge an approximate UserCounter into an exact one')
 
-def send_to_google_sheets(start_date, end_date, total_users, users_by_domain, successful_logins, successful_logins_by_domain,
-                          failed_logins, failed_logins_by_domain, password_changes, password_changes_by_domain,
-                          users_by_watched_domain, sheet_name):
-    credentials = Credentials.from_service_account_file('google-api-credentials.json')
-    service = build('sheets', 'v4', credentials=credentials)
-    range_ = sheet_name
-    sheet_metadata = service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
-    sheets = sheet_metadata.get('sheets', '')
-    sheet_names = [sheet.get('properties', {}).get('title') for sheet in sheets]
-    if range_ not in sheet_names:
-        body = {'requests': [{'addSheet': {'properties': {'title': range_}}}]}
-        service.spreadsheets().batchUpdate(spreadsheetId=SPREADSHEET_ID, body=body).execute()
-
-    values = [
+        for domain in other.emails_by_domain.keys() | other.sketches_by_domain.keys():
+            theirs = other.sketches_by_domain.get(domain)
+            their_emails = other.emails_by_domain.get(domain)
+            mergeable = theirs is not None and theirs.precision == self.precision
+            # Watched domains take the exact emails whenever they're there
+            if their_emails is not None and (domain in self.watched_domains or not mergeable):
+                for user_email, count in their_emails.items():
+                    self._add_email(domain, user_email, count)
+            elif mergeable:
+                self._sketch(domain).merge(theirs)
+            else:
+                raise ValueError(f'Cannot merge HyperLogLog precision {theirs.precision} into {self.precision}')
+
+        for mine, theirs in zip(self._counters(), other._counters()):
+            for domain, count in theirs.items():
+                mine[domain] = mine.get(domain, 0) + count
+        return self
+
+    def to_dict(self, with_sketches=True):
+        """
+        JSON-ready state. Exact counters also include sketches built at APPROXIMATE_ERROR
+        unless with_sketches is False, so approximate reports can merge registers instead
+        of rehashing emails. Domains within HyperLogLog.small_limit() get none: their
+        emails are already saved and cheaper to rehash.
+        """
+        sketches = self.sketches_by_domain
+        if self.precision is None and not with_sketches:
+            sketches = {}
+        elif self.precision is None:
+            sketches = {}
+            precision = HyperLogLog.precision_for(APPROXIMATE_ERROR)
+            for domain, emails in self.emails_by_domain.items():
+                if len(emails) > HyperLogLog.small_limit(precision):
+                    sketches[domain] = HyperLogLog(precision)
+                    sketches[domain].update(emails)
+        return {
+            'emails_by_domain': self.emails_by_domain,
+            'sketches_by_domain': {domain: sketch.to_dict() for domain, sketch in sketches.items()},
+            'successful_logins_by_domain': self.successful_logins_by_domain,
+            'failed_logins_by_domain': self.failed_logins_by_domain,
+            'password_changes_by_domain': self.password_changes_by_domain,
+            'approximate': self.precision is not None,
+            'precision': self.precision,
+        }
+
+    @classmethod
+    def from_dict(cls, data, watched_domains=()):
+        """
+        Rebuild a counter from to_dict() output, dropping domains excluded since it was saved.
+        An approximate counter comes back as approximate, at the precision it was saved with.
+        """
+        sketches = {domain: HyperLogLog.from_dict(sketch) for domain, sketch in data.get('sketches_by_domain', {}).items()
+                    if domain not in EXCLUDED_DOMAINS}
+        counter = cls(watched_domains)
+        counter.precision = data['precision']
+        counter.sketches_by_domain = sketches
+        for name, counts in zip(('emails_by_domain', 'successful_logins_by_domain',
+                                 'failed_logins_by_domain', 'password_changes_by_domain'),
+                                (counter.emails_by_domain, *counter._counters())):
+            counts.update((domain, value) for domain, value in data[name].items() if domain not in EXCLUDED_DOMAINS)
+        return counter
+
+    def result(self):
+        """The same tuple count_users returns."""
+        if self.precision is None:
+            # A user's domain is part of their address, so per-domain sets never overlap
+            unique_users_by_domain = {domain: len(emails) for domain, emails in self.emails_by_domain.items()}
+            total_users = sum(unique_users_by_domain.values())
+        else:
+            # Domains still counted exactly add up as above; sketched ones are estimated together
+            unique_users_by_domain = {domain: len(emails) for domain, emails in self.emails_by_domain.items()
+                                      if domain not in self.sketches_by_domain}
+            total_users = sum(unique_users_by_domain.values())
+            if self.sketches_by_domain:
+                everyone = HyperLogLog(self.precision)
+                for domain, sketch in self.sketches_by_domain.items():
+                    everyone.merge(sketch)
+                    unique_users_by_domain[domain] = sketch.count()
+                total_users += everyone.count()
+        users_by_domain = {domain: {'emails': emails} for domain, emails in self.emails_by_domain.items()
+                           if domain in self.watched_domains}
+
+        return (total_users, unique_users_by_domain,
+                sum(self.successful_logins_by_domain.values()), self.successful_logins_by_domain,
+                sum(self.failed_logins_by_domain.values()), self.failed_logins_by_domain,
+                sum(self.password_changes_by_domain.values()), self.password_changes_by_domain,
+                users_by_domain)
+
+
+def count_users(logs, watched_domains, approximate_error=None):
+    counter = UserCounter(watched_domains, approximate_error)
+    for log in logs:
+        counter.add(log)
+    return counter.result()
+
+
+def _rollup_key(day):
+    return f'{ROLLUP_PREFIX}{day}.json'
+
+
+def load_rollup(s3, day):
+    """Return the saved UserCounter dict for a day, or None if it hasn't been rolled up."""
+    try:
+        response = s3.get_object(Bucket=ROLLUP_BUCKET, Key=_rollup_key(day))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+def save_rollup(s3, day, counter):
+    s3.put_object(
+        Bucket=ROLLUP_BUCKET,
+        Key=_rollup_key(day),
+        Body=json.dumps({'day': day, **counter.to_dict()}, separators=(',', ':')),
+        ContentType='application/json',
+    )
+
+
+def day_is_complete(day):
+    day_end = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc) + timedelta(days=1)
+    return datetime.now(timezone.utc) >= day_end + timedelta(hours=ROLLUP_SETTLE_HOURS)
+
+
+def count_users_with_rollups(start_date, end_date, watched_domains, approximate_error=None, deadline=None,
+                             resumed_from=None):
+    """
+    Count users for a date range from the per-day rollups in ROLLUP_BUCKET.
+
+    Only days without a rollup are read from DynamoDB; complete ones are rolled up as
+    soon as their last page is read, so the next report over the same days (or a rerun
+    after a timeout) doesn't read them again.
+    Rollups are always exact (plus sketches), whatever approximate_error this report uses.
+    Each rollup is merged as soon as it loads, so at most a few are in memory at once.
+    Returns like count_users_resumable; unfinished days are only checkpointed with a deadline.
+    """
+    s3 = boto3.client('s3')
+    if resumed_from:
+        checkpoint = load_checkpoint(s3, resumed_from)
+        if checkpoint is None:
+            logger.warning(f'Checkpoint {resumed_from} was already continued from, stopping')
+            return None, None
+        cursors, saved_counter, saved_day_counters = checkpoint
+        counter = UserCounter.from_dict(saved_counter, watched_domains)
+        day_counters = {day: UserCounter.from_dict(saved) for day, saved in saved_day_counters.items()}
+    else:
+        counter = UserCounter(watched_domains, approximate_error)
+        missing = load_rollups(s3, days_between(start_date, end_date), counter)
+        cursors = {day: None for day in missing}
+        # Only days that can be rolled up need a counter of their own, and only until the
+        # day's last page: then it's saved, merged and dropped
+        day_counters = {day: UserCounter() for day in missing if day_is_complete(day)}
+    logger.info(f'{len(cursors)} days left to read')
+
+    saves = []
+    pages = iter_day_pages(list(cursors), dict(cursors), deadline)
+    pages_read = 0
+    with ThreadPoolExecutor(max_workers=MAX_PARTITION_WORKERS) as pool:
+        try:
+            for day, page, cursor in pages:
+                day_counters.get(day, counter).add_page(page)
+                pages_read += 1
+                if cursor is not None:
+                    cursors[day] = cursor
+                else:
+                    del cursors[day]
+                    if day in day_counters:
+                        day_counter = day_counters.pop(day)
+                        saves.append(pool.submit(save_rollup, s3, day, day_counter))
+                        counter.merge(day_counter)
+                if deadline is not None and time.time() >= deadline:
+                    break
+        finally:
+            pages.close()
+        for save in saves:
+            save.result()
+
+    token = checkpoint_progress(s3, resumed_from, cursors, counter, pages_read, day_counters)
+    if token:
+        return None, token
+    return counter.result(), None
+
+
+def load_rollups(s3, days, counter):
+    """Merge the days' rollups into counter and return the days that have none, in order."""
+    workers = max(1, min(MAX_PARTITION_WORKERS, len(days)))
+    missing = []
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Loads run at most `workers` days ahead of the merge
+        loads = deque()
+
+        def merge_next():
+            day, future = loads.popleft()
+            rollup = future.result()
+            if rollup is None:
+                missing.append(day)
+            else:
+                counter.merge(UserCounter.from_dict(rollup))
+
+        for day in days:
+            loads.append((day, pool.submit(load_rollup, s3, day)))
+            if len(loads) > workers:
+                merge_next()
+        while loads:
+            merge_next()
+    logger.info(f'{len(days) - len(missing)} days from rollups, {len(missing)} from DynamoDB')
+    return missing
+
+
+def _checkpoint_key(token):
+    return f'{CHECKPOINT_PREFIX}{token}.json'
+
+
+def _serialize_cursor(cursor):
+    # LastEvaluatedKey values can be Decimals (number keys), so store them in DynamoDB's
+    # typed form, which round-trips through JSON exactly
+    if cursor is None or cursor['key'] is None:
+        return cursor
+    serializer = TypeSerializer()
+    return {'query': cursor['query'], 'key': {name: serializer.serialize(value) for name, value in cursor['key'].items()}}
+
+
+def _deserialize_cursor(cursor):
+    if cursor is None or cursor['key'] is None:
+        return cursor
+    deserializer = TypeDeserializer()
+    return {'query': cursor['query'], 'key': {name: deserializer.deserialize(value) for name, value in cursor['key'].items()}}
+
+
+def save_checkpoint(s3, token, cursors, counter, day_counters=None):
+    body = {
+        'cursors': {day: _serialize_cursor(cursor) for day, cursor in cursors.items()},
+        'counter': counter.to_dict(with_sketches=False),
+        'day_counters': {day: day_counter.to_dict(with_sketches=False)
+                         for day, day_counter in (day_counters or {}).items()},
+    }
+    s3.put_object(Bucket=CHECKPOINT_BUCKET, Key=_checkpoint_key(token), Body=json.dumps(body, separators=(',', ':')))
+
+
+def load_checkpoint(s3, token):
+    """
+    Return (cursors, counter dict, day counter dicts) for a token, or None if it was
+    already continued from.
+    """
+    try:
+        response = s3.get_object(Bucket=CHECKPOINT_BUCKET, Key=_checkpoint_key(token))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    body = json.loads(response['Body'].read())
+    cursors = {day: _deserialize_cursor(cursor) for day, cursor in body['cursors'].items()}
+    return cursors, body['counter'], body['day_counters']
+
+
+def checkpoint_progress(s3, resumed_from, cursors, counter, pages_read, day_counters=None):
+    """Save unfinished days under a fresh token, drop the resumed one, and return the new token or None."""
+    if cursors and not pages_read:
+        # Continuing would save the same cursors and try again forever; the checkpoint
+        # being resumed from is kept, so the run can be retried with more time
+        raise RuntimeError(f'No pages read before the deadline with {len(cursors)} days unfinished')
+
+    token = None
+    if cursors:
+        token = uuid.uuid4().hex
+        logger.info(f'Checkpointing with {len(cursors)} days unfinished')
+        save_checkpoint(s3, token, cursors, counter, day_counters)
+    if resumed_from:
+        s3.delete_object(Bucket=CHECKPOINT_BUCKET, Key=_checkpoint_key(resumed_from))
+    return token
+
+
+def checkpoint_deadline(context):
+    """
+    time.time() at which to stop reading and checkpoint: CHECKPOINT_MARGIN_SECONDS before
+    the invocation ends, or a quarter of the remaining time if that is shorter.
+    """
+    remaining = context.get_remaining_time_in_millis() / 1000
+    return time.time() + remaining - min(CHECKPOINT_MARGIN_SECONDS, remaining / 4)
+
+
+def count_users_resumable(event, context, start_date, end_date, watched_domains, approximate_error=None):
+    """
+    Count users for a date range, checkpointing to CHECKPOINT_BUCKET near the timeout.
+    Returns (counts, None), (None, token) when checkpointed, or (None, None) if the checkpoint was used.
+    """
+    s3 = boto3.client('s3')
+    resumed_from = event.get('continuation_token')
+    if resumed_from:
+        checkpoint = load_checkpoint(s3, resumed_from)
+        if checkpoint is None:
+            logger.warning(f'Checkpoint {resumed_from} was already continued from, stopping')
+            return None, None
+        cursors, saved_counter, _ = checkpoint
+        counter = UserCounter.from_dict(saved_counter, watched_domains)
+    else:
+        cursors = {day: None for day in days_between(start_date, end_date)}
+        counter = UserCounter(watched_domains, approximate_error)
+    logger.info(f'{len(cursors)} days left to read')
+
+    # Reads stop at the deadline even while every worker is throttled and no page arrives
+    deadline = checkpoint_deadline(context)
+    pages = iter_day_pages(list(cursors), dict(cursors), deadline)
+    pages_read = 0
+    try:
+        for day, page, cursor in pages:
+            counter.add_page(page)
+            pages_read += 1
+            if cursor is None:
+                del cursors[day]
+            else:
+                cursors[day] = cursor
+            if time.time() >= deadline:
+                break
+    finally:
+        pages.close()
+
+    token = checkpoint_progress(s3, resumed_from, cursors, counter, pages_read)
+    if token:
+        return None, token
+    return counter.result(), None
+
+
+def continue_later(event, context, start_date, end_date, token):
+    """
+    Hand a checkpointed run on: invoke the function again (or, with checkpoint_mode
+    'return', return the next event), up to MAX_CHECKPOINT_HOPS times.
+    """
+    hop = int(event.get('checkpoint_hop', 0)) + 1
+    next_event = dict(event, start_date=start_date, end_date=end_date, continuation_token=token,
+                      checkpoint_hop=hop)
+    if hop > MAX_CHECKPOINT_HOPS:
+        logger.error(f'Still unfinished after {MAX_CHECKPOINT_HOPS} invocations, not continuing')
+        return {
+            'statusCode': 500,
+            'body': {'continuation_token': token, 'next_event': next_event}
+        }
+    if event.get('checkpoint_mode', 'self-invoke') == 'self-invoke':
+        logger.info(f'Continuing in a new invocation with token {token}')
+        boto3.client('lambda').invoke(
+            FunctionName=context.function_name,
+            InvocationType='Event',
+            Payload=json.dumps(next_event),
+        )
+    return {
+        'statusCode': 202,
+        'body': {'continuation_token': token, 'next_event': next_event}
+    }
+
+
+def count_users_fan_out(function_name, children, watched_domains, approximate_error=None):
+    """
+    Split a SCAN_SEGMENTS parallel scan across child invocations of this function and
+    merge the partial aggregates they return.
+
+    Each child returns its UserCounter as JSON, which has to fit in Lambda's 6 MB response
+    limit. With approximate_error, domains with more than HyperLogLog.small_limit() users
+    (1024 at 2%) are sent as sketches, but watched domains and every smaller domain still
+    carry all their addresses, so a table with many small domains can exceed the limit
+    either way.
+    """
+    lambda_client = boto3.client('lambda', config=Config(
+        read_timeout=TIMEOUT_SECONDS + 60,
+        retries={'max_attempts': 0},  # a retried child would scan its segments twice
+    ))
+    children = max(1, min(children, SCAN_SEGMENTS))
+    assignments = [list(range(SCAN_SEGMENTS))[child::children] for child in range(children)]
+
+    def invoke(segments):
+        response = lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType='RequestResponse',
+            Payload=json.dumps({
+                'scan_segments': segments,
+                'total_segments': SCAN_SEGMENTS,
+                'watched_domains': list(watched_domains),
+                'approximate_error': approximate_error,
+            }),
+        )
+        payload = json.loads(response['Payload'].read())
+        if response.get('FunctionError') or payload.get('statusCode') != 200:
+            raise RuntimeError(f'Scan of segments {segments} failed: {payload}')
+        return UserCounter.from_dict(payload['body'])
+
+    logger.info(f'Scanning {SCAN_SEGMENTS} segments across {children} child invocations')
+    counter = UserCounter(watched_domains, approximate_error)
+    with ThreadPoolExecutor(max_workers=children) as pool:
+        for partial in pool.map(invoke, assignments):
+            counter.merge(partial)
+    return counter.result()
+
+
+def get_sheets_service():
+    global _sheets_service
+    if _sheets_service is None:
+        credentials = Credentials.from_service_account_file('google-api-credentials.json')
+        _sheets_service = build('sheets', 'v4', credentials=credentials, cache_discovery=False)
+    return _sheets_service
+
+
+def build_report_rows(start_date, end_date, total_users, users_by_domain, successful_logins, successful_logins_by_domain,
+                      failed_logins, failed_logins_by_domain, password_changes, password_changes_by_domain,
+                      users_by_watched_domain):
+    return [
         [f"Report for {start_date} to {end_date}"], ['', ''],
         ['Metrics', 'Total'],
         ['Active Accounts', total_users],
@@ -296,9 +1097,70 @@ def send_to_google_sheets(start_date, end_date, total_users, users_by_domain, su
         *[[f"{domain}", f"{user_email}", f"{data['emails'][user_email]}"] for domain, data in users_by_watched_domain.items() for user_email in data['emails']],
     ]
 
-    service.spreadsheets().values().update(
+
+def _cell(value):
+    # Same as valueInputOption RAW: numbers stay numbers, strings are never parsed
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+
+def send_to_google_sheets(start_date, end_date, total_users, users_by_domain, successful_logins, successful_logins_by_domain,
+                          failed_logins, failed_logins_by_domain, password_changes, password_changes_by_domain,
+                          users_by_watched_domain, sheet_name):
+    """
+    Write the report to sheet_name, creating or growing the sheet in the same batchUpdate
+    as the first rows. Rows go out as updateCells requests of SHEETS_ROWS_PER_REQUEST,
+    SHEETS_REQUESTS_PER_BATCH per call, and rows left over from a longer earlier report
+    are cleared.
+    """
+    service = get_sheets_service()
+    values = build_report_rows(start_date, end_date, total_users, users_by_domain, successful_logins,
+                               successful_logins_by_domain, failed_logins, failed_logins_by_domain, password_changes,
+                               password_changes_by_domain, users_by_watched_domain)
+
+    sheet_metadata = service.spreadsheets().get(
         spreadsheetId=SPREADSHEET_ID,
-        range=range_,
-        valueInputOption='RAW',
-        body={'values': values}
+        fields='sheets.properties(sheetId,title,gridProperties.rowCount)'
     ).execute()
+    sheets = {sheet['properties']['title']: sheet['properties'] for sheet in sheet_metadata.get('sheets', [])}
+
+    requests = []
+    row_count = len(values)
+    if sheet_name in sheets:
+        sheet_id = sheets[sheet_name]['sheetId']
+        existing_rows = sheets[sheet_name].get('gridProperties', {}).get('rowCount', 0)
+        if existing_rows < row_count:
+            requests.append({'updateSheetProperties': {
+                'properties': {'sheetId': sheet_id, 'gridProperties': {'rowCount': row_count}},
+                'fields': 'gridProperties.rowCount',
+            }})
+    else:
+        existing_ids = {properties['sheetId'] for properties in sheets.values()}
+        sheet_id = random.randint(1, 2 ** 31 - 1)
+        while sheet_id in existing_ids:
+            sheet_id = random.randint(1, 2 ** 31 - 1)
+        existing_rows = 0
+        requests.append({'addSheet': {'properties': {
+            'sheetId': sheet_id, 'title': sheet_name, 'gridProperties': {'rowCount': row_count},
+        }}})
+
+    for first_row in range(0, row_count, SHEETS_ROWS_PER_REQUEST):
+        chunk = values[first_row:first_row + SHEETS_ROWS_PER_REQUEST]
+        requests.append({'updateCells': {
+            'start': {'sheetId': sheet_id, 'rowIndex': first_row, 'columnIndex': 0},
+            'rows': [{'values': [_cell(value) for value in row]} for row in chunk],
+            'fields': 'userEnteredValue',
+        }})
+    if existing_rows > row_count:
+        # Without rows, updateCells clears the fields in the range
+        requests.append({'updateCells': {
+            'range': {'sheetId': sheet_id, 'startRowIndex': row_count},
+            'fields': 'userEnteredValue',
+        }})
+
+    for offset in range(0, len(requests), SHEETS_REQUESTS_PER_BATCH):
+        service.spreadsheets().batchUpdate(
+            spreadsheetId=SPREADSHEET_ID,
+            body={'requests': requests[offset:offset + SHEETS_REQUESTS_PER_BATCH]}
+        ).execute()
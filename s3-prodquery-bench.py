@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+
+"""
+Offline benchmark for s3-prodquery.py against a moto-backed synthetic account.
+
+Builds a fake account with thousands of buckets spread over a few regions, with a mix of
+environment tags and CloudWatch storage/request metrics. Object counts run from 0 to millions;
+ListObjectsV2 is answered by a stub that makes up pages on the fly, because moto can't hold
+millions of real keys. Each scenario (default, lazy, crawl, ...) times analyze_all_buckets end
+to end and per check, and counts API calls with the analyzer's CallProfiler.
+
+Wall times are dominated by moto, so only compare them against a baseline taken on the same
+machine. API call counts are deterministic for a given --seed and are the number to watch.
+
+USAGE:
+python s3-prodquery-bench.py --save-baseline s3-bench-baseline.json
+python s3-prodquery-bench.py --baseline s3-bench-baseline.json   # exits 1 on regressions
+"""
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+# moto has to see fake credentials before boto3 builds any session.
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import boto3
+from botocore.awsrequest import AWSResponse
+from moto import mock_aws
+
+
+REGIONS = ['us-east-1', 'eu-west-1', 'us-west-2']
+NAME_KINDS = ['prod', 'dev', 'app', 'data', 'test', 'staging']
+ENVIRONMENT_TAGS = ['prod', 'production', 'dev', 'staging', 'test', None, None]
+PAGE_SIZE = 1000
+BYTES_PER_LISTED_KEY = 320  # rough size of one <Contents> element, for the profiler's byte counts
+REQUEST_METRICS_FILTER = 'EntireBucket'  # the analyzer's default FilterId
+
+# Scenario name -> extra S3ProductionAnalyzer arguments. 'cached-rerun' also runs a warm-up pass.
+SCENARIOS = {
+    'default': {},
+    'lazy': {'lazy': True},
+    'crawl': {'sizing': 'crawl'},
+    'prefix-scan-recency': {'recency': ['inventory', 'put-metrics', 'prefix-scan']},
+    'cached-rerun': {},
+    'full-crawl': {'sizing': 'crawl', 'crawl_stop_after': None},
+}
+DEFAULT_SCENARIOS = ['default', 'lazy', 'crawl', 'prefix-scan-recency', 'cached-rerun']
+
+
+def load_analyzer_module():
+    """Import s3-prodquery.py from next to this script (the dash keeps it from being a normal import)."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 's3-prodquery.py')
+    spec = importlib.util.spec_from_file_location('s3_prodquery', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_account_spec(bucket_count, max_objects, seed):
+    """Decide every synthetic bucket's name, region, tags, object count and activity up front."""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    buckets = {}
+
+    for index in range(bucket_count):
+        name = f"bench-{rng.choice(NAME_KINDS)}-{index:05d}"
+        # A fifth are empty, the rest log-uniform up to max_objects.
+        objects = 0 if rng.random() < 0.2 else int(10 ** rng.uniform(0, math.log10(max_objects)))
+        buckets[name] = {
+            'region': rng.choice(REGIONS),
+            'environment': rng.choice(ENVIRONMENT_TAGS),
+            'objects': objects,
+            'prefixes': min(max(objects // 5000, 1), 200),
+            'newest': now - timedelta(hours=rng.uniform(1, 24 * 60)),
+            'requests': rng.choice([0, 50, 500, 50000]),
+            'downloaded': rng.choice([0, 1024 ** 3, 50 * 1024 ** 3]),
+        }
+    return buckets
+
+
+def create_account(buckets):
+    """Create the buckets, tags and CloudWatch datapoints in moto."""
+    now = datetime.now(timezone.utc)
+
+    for region in REGIONS:
+        s3 = boto3.client('s3', region_name=region)
+        cloudwatch = boto3.client('cloudwatch', region_name=region)
+        metric_data = []
+
+        for name, spec in buckets.items():
+            if spec['region'] != region:
+                continue
+
+            if region == 'us-east-1':
+                s3.create_bucket(Bucket=name)
+            else:
+                s3.create_bucket(Bucket=name, CreateBucketConfiguration={'LocationConstraint': region})
+            if spec['environment']:
+                s3.put_bucket_tagging(
+                    Bucket=name,
+                    Tagging={'TagSet': [{'Key': 'Environment', 'Value': spec['environment']}, {'Key': 'team', 'Value': 'bench'}]},
+                )
+
+            def datapoint(metric_name, value, timestamp, storage_type=None):
+                dimensions = [{'Name': 'BucketName', 'Value': name}]
+                if storage_type:
+                    dimensions.append({'Name': 'StorageType', 'Value': storage_type})
+                else:
+                    # Request metrics only exist per filter, as on a real account
+                    dimensions.append({'Name': 'FilterId', 'Value': REQUEST_METRICS_FILTER})
+                return {'MetricName': metric_name, 'Dimensions': dimensions, 'Timestamp': timestamp, 'Value': value}
+
+            if spec['objects']:
+                metric_data.append(datapoint('NumberOfObjects', spec['objects'], now - timedelta(hours=6), 'AllStorageTypes'))
+                metric_data.append(datapoint('BucketSizeBytes', spec['objects'] * 4096, now - timedelta(hours=6), 'StandardStorage'))
+            if spec['requests']:
+                metric_data.append(datapoint('AllRequests', spec['requests'], now - timedelta(hours=2)))
+            if spec['downloaded']:
+                metric_data.append(datapoint('BytesDownloaded', spec['downloaded'], now - timedelta(days=2)))
+            if spec['newest'] > now - timedelta(days=7):
+                metric_data.append(datapoint('PutRequests', 10, spec['newest']))
+
+        for offset in range(0, len(metric_data), 1000):
+            cloudwatch.put_metric_data(Namespace='AWS/S3', MetricData=metric_data[offset:offset + 1000])
+
+
+class ListingStub:
+    """
+    Answer ListObjectsV2 from the bucket spec instead of moto, page by page.
+
+    Keys are p000/obj000000000 ... spread evenly over the bucket's prefixes, and LastModified
+    grows with the key so the newest object is always the last one listed. That is the worst
+    case for the old first-100-keys sample.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+
+    def register(self, session):
+        session.events.register('before-parameter-build.s3.ListObjectsV2', self._remember_params)
+        session.events.register('before-call.s3.ListObjectsV2', self._list)
+
+    @staticmethod
+    def _remember_params(params, context, **kwargs):
+        context['bench_params'] = dict(params)
+
+    def _list(self, context, **kwargs):
+        params = context['bench_params']
+        spec = self.buckets.get(params['Bucket'])
+        if spec is None:
+            return None  # let moto answer (and 404) for anything we didn't synthesise
+
+        prefix = params.get('Prefix', '')
+        page_size = min(params.get('MaxKeys', PAGE_SIZE), PAGE_SIZE)
+        offset = int(params.get('ContinuationToken') or 0)
+        parsed = {'Name': params['Bucket'], 'Prefix': prefix, 'MaxKeys': page_size, 'IsTruncated': False, 'KeyCount': 0}
+
+        if params.get('Delimiter') == '/' and not prefix:
+            # Top level: every object lives under a prefix.
+            if spec['objects']:
+                parsed['CommonPrefixes'] = [{'Prefix': f"p{index:03d}/"} for index in range(spec['prefixes'])]
+                parsed['KeyCount'] = spec['prefixes']
+        else:
+            if prefix:
+                prefix_index = int(prefix[1:4])
+                first, count = self._prefix_range(spec, prefix_index)
+            else:
+                first, count = 0, spec['objects']
+
+            end = min(offset + page_size, count)
+            contents = [self._object(spec, first + position) for position in range(offset, end)]
+            if contents:
+                parsed['Contents'] = contents
+            parsed['KeyCount'] = len(contents)
+            if end < count:
+                parsed['IsTruncated'] = True
+                parsed['NextContinuationToken'] = str(end)
+
+        headers = {'content-length': str(200 + BYTES_PER_LISTED_KEY * parsed['KeyCount'])}
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': 200, 'HTTPHeaders': headers, 'RetryAttempts': 0}
+        return AWSResponse(f"https://{params['Bucket']}.s3.amazonaws.com/", 200, headers, None), parsed
+
+    @staticmethod
+    def _prefix_range(spec, prefix_index):
+        """(index of the prefix's first object in listing order, objects under the prefix)."""
+        base, extra = divmod(spec['objects'], spec['prefixes'])
+        first = prefix_index * base + min(prefix_index, extra)
+        return first, base + (1 if prefix_index < extra else 0)
+
+    @staticmethod
+    def _object(spec, index):
+        base, extra = divmod(spec['objects'], spec['prefixes'])
+        if index < extra * (base + 1):
+            prefix_index, position = divmod(index, base + 1)
+        else:
+            prefix_index, position = divmod(index - extra * (base + 1), base)
+            prefix_index += extra
+
+        return {
+            'Key': f"p{prefix_index:03d}/obj{position:09d}",
+            'LastModified': spec['newest'] - timedelta(seconds=spec['objects'] - 1 - index),
+            'Size': 4096,
+            'ETag': '"bench"',
+            'StorageClass': 'STANDARD',
+        }
+
+
+def run_scenario(module, buckets, name, workers):
+    """Run one scenario on a fresh analyzer and return its timings and call counts."""
+    kwargs = dict(SCENARIOS[name], max_workers=workers)
+    cache_path = None
+
+    def analyzer_for(profiler, cache=None):
+        session = boto3.Session(region_name='us-east-1')
+        ListingStub(buckets).register(session)
+        return module.S3ProductionAnalyzer(session=session, profiler=profiler, cache=cache, **kwargs)
+
+    if name == 'cached-rerun':
+        cache_path = os.path.join(tempfile.mkdtemp(prefix='s3-bench-'), 'signals.sqlite')
+        warm_cache = module.SignalCache(cache_path)
+        warm_up = analyzer_for(None, warm_cache)
+        try:
+            warm_up.analyze_all_buckets(report=False, keep_results=False)
+        finally:
+            warm_up.close()
+            warm_cache.close()
+
+    cache = module.SignalCache(cache_path) if cache_path else None
+    profiler = module.CallProfiler()
+    analyzer = analyzer_for(profiler, cache)
+
+    try:
+        started = time.monotonic()
+        results = analyzer.analyze_all_buckets(report=False)
+        wall_seconds = time.monotonic() - started
+    finally:
+        analyzer.close()
+        if cache is not None:
+            cache.close()
+
+    checks = profiler.totals()
+    return {
+        'wall_seconds': round(wall_seconds, 3),
+        'api_calls': sum(counts.get('calls', 0) for counts in checks.values()),
+        'bands': dict(sorted(Counter(result['band'] for result in results).items())),
+        'checks': {
+            check: {
+                'calls': counts.get('calls', 0),
+                'seconds': round(counts.get('seconds', 0.0), 3),
+                'operations': counts['operations'],
+            }
+            for check, counts in sorted(checks.items())
+        },
+    }
+
+
+def compare(report, baseline, wall_tolerance):
+    """Return a list of human-readable regressions of report against baseline."""
+    regressions = []
+    for scenario, current in report['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(scenario)
+        if previous is None:
+            continue
+
+        if current['api_calls'] > previous['api_calls']:
+            regressions.append(f"{scenario}: API calls {previous['api_calls']} -> {current['api_calls']}")
+        for check, counts in current['checks'].items():
+            before = previous['checks'].get(check, {}).get('calls', 0)
+            if counts['calls'] > before:
+                regressions.append(f"{scenario}/{check}: API calls {before} -> {counts['calls']}")
+        if current['wall_seconds'] > previous['wall_seconds'] * (1 + wall_tolerance):
+            regressions.append(f"{scenario}: wall time {previous['wall_seconds']:.2f}s -> {current['wall_seconds']:.2f}s")
+        if current['bands'] != previous['bands']:
+            regressions.append(f"{scenario}: band counts changed {previous['bands']} -> {current['bands']}")
+    return regressions
+
+
+def print_report(report):
+    print(f"S3 analyzer benchmark: {report['buckets']} buckets, up to {report['max_objects']:,} objects, seed {report['seed']}")
+    for scenario, result in report['scenarios'].items():
+        print()
+        print(f"📊 {scenario}: {result['wall_seconds']:.2f}s, {result['api_calls']} API calls, bands {result['bands']}")
+        for check, counts in result['checks'].items():
+            operations = ', '.join(f"{operation}={calls}" for operation, calls in counts['operations'].items())
+            print(f"    {check:<14}{counts['seconds']:>9.2f}s{counts['calls']:>8} calls  {operations}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark s3-prodquery.py against a synthetic moto account.')
+    parser.add_argument('--buckets', type=int, default=2000, help='Synthetic buckets to create')
+    parser.add_argument('--max-objects', type=int, default=2000000, help='Largest synthetic object count')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=16, help='Analyzer bucket workers')
+    parser.add_argument('--scenarios', default=','.join(DEFAULT_SCENARIOS),
+                        help=f"Comma-separated scenarios to run ({', '.join(SCENARIOS)})")
+    parser.add_argument('--baseline', help='Compare against this baseline JSON and exit 1 on regressions')
+    parser.add_argument('--save-baseline', help='Write this run\'s numbers to a baseline JSON')
+    parser.add_argument('--wall-tolerance', type=float, default=0.25,
+                        help='Allowed wall time growth over the baseline, as a fraction')
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios.split(',')) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    return args
+
+
+def main():
+    args = parse_args()
+    module = load_analyzer_module()
+    buckets = build_account_spec(args.buckets, args.max_objects, args.seed)
+
+    report = {'buckets': args.buckets, 'max_objects': args.max_objects, 'seed': args.seed, 'scenarios': {}}
+    with mock_aws():
+        create_account(buckets)
+        for scenario in args.scenarios.split(','):
+            report['scenarios'][scenario] = run_scenario(module, buckets, scenario, args.workers)
+
+    print_report(report)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"\n💾 Baseline written to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.wall_tolerance)
+        if regressions:
+            print("\n❌ REGRESSIONS:")
+            for regression in regressions:
+                print(f"  • {regression}")
+            sys.exit(1)
+        print("\n✅ No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,324 +4,1613 @@
 This script is vibe-coded, and can only tell lies. It could *probably* be improved and made more useful.
 Consider the various following readouts to be interfaces to be *implemented*.
 It was a quick hack to solve a problem I needed a complex answer for fast.
+
+Usage: s3-prodquery.py [--sizing BACKEND] [--role-arn ARN ...] [--output PATH]
+See --help for every option.
 """
 
+import argparse
 import boto3
+import contextlib
+import contextvars
+import csv
+import gzip
+import heapq
+import os
 import re
-from datetime import datetime, timedelta
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
 from botocore.exceptions import ClientError, BotoCoreError
 import json
 
+# Score thresholds for each band, highest first. Anything below the last one is WHITE.
+BANDS = (
+    (5, 'RED'),
+    (2, 'YELLOW'),
+    (0, 'GREEN'),
+)
+
+# CloudWatch metrics read per bucket, and how their datapoints collapse into one value:
+# 'sum' totals a single period covering the whole lookback window, 'latest' keeps the newest
+# daily storage datapoint, 'last-active' records the newest day with a non-zero value.
+# BucketSizeBytes only counts STANDARD storage, NumberOfObjects counts every storage class.
+# 'filtered' metrics are S3 request metrics, which CloudWatch only publishes per request
+# metrics filter, so they're read with a FilterId dimension as well as BucketName.
+METRICS = {
+    'AllRequests': {'days': 7, 'period': 7 * 86400, 'stat': 'Sum', 'reduce': 'sum', 'filtered': True},
+    'BytesDownloaded': {'days': 30, 'period': 30 * 86400, 'stat': 'Sum', 'reduce': 'sum', 'filtered': True},
+    'PutRequests': {'days': 7, 'period': 86400, 'stat': 'Sum', 'reduce': 'last-active', 'filtered': True},
+    'BucketSizeBytes': {'days': 3, 'period': 86400, 'stat': 'Average', 'reduce': 'latest',
+                        'dimensions': {'StorageType': 'StandardStorage'}},
+    'NumberOfObjects': {'days': 3, 'period': 86400, 'stat': 'Average', 'reduce': 'latest',
+                        'dimensions': {'StorageType': 'AllStorageTypes'}},
+}
+REQUEST_METRICS = ('AllRequests', 'BytesDownloaded')
+STORAGE_METRICS = ('BucketSizeBytes', 'NumberOfObjects')
+MAX_METRIC_DATA_QUERIES = 500  # GetMetricData hard limit per call
+# Request metrics filter to read request metrics from. The console names a whole-bucket
+# filter 'EntireBucket'; buckets without it have no request metrics at all.
+DEFAULT_REQUEST_METRICS_FILTER = 'EntireBucket'
+
+# How long each cached signal stays fresh, in seconds. Storage metrics and the contents
+# sizing built from them only change on CloudWatch's daily cadence.
+SIGNAL_TTLS = {
+    'tags': 86400,
+    'AllRequests': 3600,
+    'BytesDownloaded': 3600,
+    'PutRequests': 3600,
+    'BucketSizeBytes': 86400,
+    'NumberOfObjects': 86400,
+    'contents': 86400,
+    'recency': 3600,
+    'region': 7 * 86400,  # buckets never move, this only bounds how long a deleted name lingers
+}
+
+# Buckets holding more objects than this get +1. Listings can stop as soon as it's crossed.
+LARGE_OBJECT_COUNT = 1000
+
+# Where _check_contents gets object counts and sizes from: backend name -> method.
+# Each returns {'objects', 'bytes', 'exact', 'source'}, or None when it has nothing for the bucket.
+SIZING_BACKENDS = {
+    'storage-metrics': '_size_from_storage_metrics',
+    'inventory': '_size_from_inventory',
+    'crawl': '_size_from_crawl',
+}
+
+# Where _check_recent_modifications finds the newest write: backend name -> method. Each returns
+# {'last_modified', 'source', 'exact'} (last_modified is None when nothing was written), or None
+# when it has nothing for the bucket. 'sample' is the old first-100-keys guess, one call per bucket;
+# 'prefix-scan' costs up to 1 + prefix_scan_limit calls per bucket, so it is opt-in via --recency.
+RECENCY_BACKENDS = {
+    'inventory': '_recency_from_inventory',
+    'put-metrics': '_recency_from_put_metrics',
+    'prefix-scan': '_recency_from_prefix_scan',
+    'sample': '_recency_from_sample',
+}
+DEFAULT_RECENCY = ('inventory', 'put-metrics', 'sample')
+
+# Checks in report order. min/max are the most a check can take away from or add to the
+# score, which lets lazy scoring skip checks once the band can't change. Lower cost runs first.
+CHECKS = (
+    {'name': 'naming', 'method': '_check_naming_patterns', 'label': None,
+     'min': -2, 'max': 3, 'cost': 0},
+    {'name': 'tags', 'method': '_check_tags', 'label': '📋 Checking tags...',
+     'min': -3, 'max': 5, 'cost': 2},
+    {'name': 'activity', 'method': '_check_recent_activity', 'label': '📊 Checking recent activity...',
+     'min': 0, 'max': 3, 'cost': 1},
+    {'name': 'transfer', 'method': '_check_data_transfer', 'label': '📈 Checking data transfer...',
+     'min': 0, 'max': 2, 'cost': 1},
+    {'name': 'contents', 'method': '_check_contents', 'label': '📦 Checking contents...',
+     'min': 0, 'max': 1, 'cost': 4},
+    {'name': 'modifications', 'method': '_check_recent_modifications', 'label': '🕒 Checking recent modifications...',
+     'min': 0, 'max': 1, 'cost': 3},
+)
+
+
+def score_band(score):
+    """Map a production score to its RED/YELLOW/GREEN/WHITE band."""
+    for threshold, band in BANDS:
+        if score >= threshold:
+            return band
+    return 'WHITE'
+
+
+def _snake_case(name):
+    """Normalise CSV inventory headers (LastModifiedDate) to the ORC/Parquet column names (last_modified_date)."""
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name.strip()).lower()
+
+
+def find_inventory_manifests(inventory_root):
+    """
+    Map source bucket -> newest manifest.json under a local mirror of an S3 Inventory destination.
+
+    Inventory reports are laid out as <prefix>/<source bucket>/<config id>/<YYYY-MM-DDTHH-MMZ>/manifest.json,
+    and the timestamp directories sort lexically.
+    """
+    manifests = {}
+    for dirpath, _dirnames, filenames in os.walk(inventory_root):
+        if 'manifest.json' not in filenames:
+            continue
+        parts = os.path.normpath(os.path.relpath(dirpath, inventory_root)).split(os.sep)
+        if len(parts) < 3:
+            continue
+        bucket_name, stamp = parts[-3], parts[-1]
+        if bucket_name not in manifests or stamp > manifests[bucket_name][0]:
+            manifests[bucket_name] = (stamp, os.path.join(dirpath, 'manifest.json'))
+    return {bucket_name: path for bucket_name, (_stamp, path) in manifests.items()}
+
+
+def parse_inventory_timestamp(value):
+    """Turn an inventory LastModifiedDate (CSV string or columnar datetime) into an aware datetime."""
+    if isinstance(value, str):
+        value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def iter_inventory_rows(manifest_path, inventory_root, columns=('size',)):
+    """
+    Stream rows from every data file listed in an inventory manifest, one dict per object.
+
+    Only the requested columns are read. Noncurrent versions and delete markers are skipped when
+    the inventory includes version columns. ORC and Parquet need pyarrow; CSV does not.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    file_format = manifest['fileFormat'].upper()
+    wanted = list(columns) + ['is_latest', 'is_delete_marker']
+
+    for data_file in manifest['files']:
+        path = os.path.join(inventory_root, data_file['key'])
+
+        if file_format == 'CSV':
+            fields = [_snake_case(field) for field in manifest['fileSchema'].split(',')]
+            with gzip.open(path, 'rt', newline='') as f:
+                for values in csv.reader(f):
+                    row = dict(zip(fields, values))
+                    if row.get('is_latest', 'true') != 'true' or row.get('is_delete_marker', 'false') == 'true':
+                        continue
+                    yield {column: row.get(column) for column in columns}
+        else:
+            for batch in _iter_columnar_batches(file_format, path, wanted):
+                for row in batch.to_pylist():
+                    if row.get('is_latest') is False or row.get('is_delete_marker'):
+                        continue
+                    yield {column: row.get(column) for column in columns}
+
+
+def _iter_columnar_batches(file_format, path, columns):
+    """Yield pyarrow record batches from an ORC or Parquet inventory file, one stripe/row group at a time."""
+    try:
+        import pyarrow.orc as orc
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError(f"pyarrow is required to read {file_format} inventory files")
+
+    if file_format == 'PARQUET':
+        parquet_file = pq.ParquetFile(path)
+        present = [column for column in columns if column in parquet_file.schema_arrow.names]
+        yield from parquet_file.iter_batches(columns=present)
+    elif file_format == 'ORC':
+        orc_file = orc.ORCFile(path)
+        present = [column for column in columns if column in orc_file.schema.names]
+        for stripe in range(orc_file.nstripes):
+            yield orc_file.read_stripe(stripe, columns=present)
+    else:
+        raise ValueError(f"Unsupported inventory format: {file_format}")
+
+
+# Flat per-bucket record written by the result sinks, one column per check score/timing.
+RECORD_FIELDS = (
+    ['bucket', 'account', 'region', 'score', 'band', 'error', 'seconds']
+    + [f"{check['name']}_{field}" for check in CHECKS for field in ('score', 'seconds', 'skipped')]
+    + ['indicators']
+)
+
+
+def result_record(result):
+    """Flatten a score_bucket() result into a RECORD_FIELDS dict."""
+    record = {field: None for field in RECORD_FIELDS}
+    for field in ('bucket', 'account', 'region', 'score', 'band', 'error', 'seconds'):
+        record[field] = result.get(field)
+
+    for check in result.get('checks', []):
+        record[f"{check['check']}_score"] = check['score']
+        record[f"{check['check']}_seconds"] = check['seconds']
+        record[f"{check['check']}_skipped"] = check.get('skipped', False)
+
+    record['indicators'] = list(result.get('indicators', []))
+    return record
+
+
+class JsonlSink:
+    """Write one JSON record per bucket, flushed as each bucket is scored."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+
+    def write(self, result):
+        line = json.dumps(result_record(result), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class CsvSink:
+    """Write one CSV row per bucket, flushed as each bucket is scored. Indicators are joined with ' | '."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=RECORD_FIELDS)
+        self._writer.writeheader()
+
+    def write(self, result):
+        record = result_record(result)
+        record['indicators'] = ' | '.join(record['indicators'])
+        with self._lock:
+            self._writer.writerow(record)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetSink:
+    """
+    Write bucket records to Parquet one row group at a time, so memory stays bounded by batch_size.
+
+    Needs pyarrow, which is only imported when this sink is used.
+    """
+
+    def __init__(self, path, batch_size=1000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("pyarrow is required to write Parquet output")
+
+        columns = [
+            ('bucket', pa.string()), ('account', pa.string()), ('region', pa.string()),
+            ('score', pa.int64()), ('band', pa.string()), ('error', pa.string()), ('seconds', pa.float64()),
+        ]
+        for check in CHECKS:
+            columns += [
+                (f"{check['name']}_score", pa.int64()),
+                (f"{check['name']}_seconds", pa.float64()),
+                (f"{check['name']}_skipped", pa.bool_()),
+            ]
+        columns.append(('indicators', pa.list_(pa.string())))
+
+        self._pa = pa
+        self._schema = pa.schema(columns)
+        self._writer = pq.ParquetWriter(path, self._schema)
+        self._batch_size = batch_size
+        self._rows = []
+        self._lock = threading.Lock()
+
+    def write(self, result):
+        with self._lock:
+            self._rows.append(result_record(result))
+            if len(self._rows) >= self._batch_size:
+                self._flush()
+
+    def _flush(self):
+        if self._rows:
+            self._writer.write_table(self._pa.Table.from_pylist(self._rows, schema=self._schema))
+            self._rows = []
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._writer.close()
+
+
+RESULT_SINKS = {
+    'jsonl': JsonlSink,
+    'csv': CsvSink,
+    'parquet': ParquetSink,
+}
+
+
+# Error codes botocore retries as throttling, counted separately from other retries.
+THROTTLE_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'SlowDown',
+}
+
+# (bucket, check) the current thread is working for, read by CallProfiler's event hooks.
+_profile_context = contextvars.ContextVar('profile_context', default=('-', 'other'))
+
+
+class CallProfiler:
+    """
+    Per-check wall time, API calls, retries, throttles and bytes received.
+
+    Counts come from botocore event hooks on every client the analyzer creates, and are
+    attributed to whichever (bucket, check) is active in the calling thread's context.
+    """
+
+    def __init__(self, top=10):
+        self.top = top
+        self._lock = threading.Lock()
+        self._checks = defaultdict(Counter)    # check -> calls/attempts/throttles/bytes/seconds/runs
+        self._operations = Counter()           # (check, operation) -> calls
+        self._buckets = {}                     # bucket -> wall seconds
+        self._slowest_checks = []              # min-heap of (seconds, bucket, check), top N kept
+
+    def attach(self, client):
+        """Register the counting hooks on a boto3 client."""
+        events = client.meta.events
+        # Counted before the request is built, so calls answered by a before-call stub still count.
+        events.register('before-parameter-build', self._on_call)
+        events.register('before-send', self._on_send)
+        events.register('needs-retry', self._on_needs_retry)
+        events.register('after-call', self._on_after_call)
+
+    @contextlib.contextmanager
+    def context(self, bucket_name, check):
+        """Attribute API calls made inside this block, in this thread, to (bucket, check)."""
+        token = _profile_context.set((bucket_name, check))
+        try:
+            yield
+        finally:
+            _profile_context.reset(token)
+
+    def _count(self, field, amount=1):
+        _bucket_name, check = _profile_context.get()
+        with self._lock:
+            self._checks[check][field] += amount
+
+    def _on_call(self, model, **kwargs):
+        _bucket_name, check = _profile_context.get()
+        with self._lock:
+            self._checks[check]['calls'] += 1
+            self._operations[(check, model.name)] += 1
+
+    def _on_send(self, **kwargs):
+        self._count('attempts')
+
+    def _on_needs_retry(self, response=None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            self._count('throttles')
+
+    def _on_after_call(self, http_response=None, model=None, **kwargs):
+        if http_response is None:
+            return
+        length = http_response.headers.get('content-length')
+        if length is None and not (model is not None and model.has_streaming_output):
+            # Non-streaming bodies are already read, so this doesn't consume anything.
+            length = len(http_response.content or b'')
+        self._count('bytes', int(length or 0))
+
+    def record_check(self, bucket_name, check, seconds):
+        with self._lock:
+            self._checks[check]['seconds'] += seconds
+            self._checks[check]['runs'] += 1
+            entry = (seconds, bucket_name, check)
+            if len(self._slowest_checks) < self.top:
+                heapq.heappush(self._slowest_checks, entry)
+            else:
+                heapq.heappushpop(self._slowest_checks, entry)
+
+    def record_bucket(self, bucket_name, seconds):
+        with self._lock:
+            self._buckets[bucket_name] = seconds
+
+    def totals(self):
+        """Return {check: counters} with retries worked out, for callers that want the raw numbers."""
+        with self._lock:
+            checks = {check: dict(counts) for check, counts in self._checks.items()}
+            operations = Counter(self._operations)
+
+        for check, counts in checks.items():
+            counts['retries'] = max(counts.get('attempts', 0) - counts.get('calls', 0), 0)
+            counts['operations'] = {
+                operation: calls for (op_check, operation), calls in sorted(operations.items()) if op_check == check
+            }
+        return checks
+
+    def print_summary(self):
+        """Print per-check totals and the slowest buckets and checks."""
+        with self._lock:
+            checks = {check: Counter(counts) for check, counts in self._checks.items()}
+            slowest_buckets = heapq.nlargest(self.top, self._buckets.items(), key=lambda x: x[1])
+            slowest_checks = sorted(self._slowest_checks, reverse=True)
+
+        print()
+        print("⏱️  CHECK PROFILE:")
+        print(f"  {'check':<14}{'runs':>7}{'seconds':>11}{'avg ms':>9}{'calls':>8}{'retries':>9}{'throttles':>11}{'KiB':>10}")
+        for check, counts in sorted(checks.items(), key=lambda x: x[1]['seconds'], reverse=True):
+            average = counts['seconds'] / counts['runs'] * 1000 if counts['runs'] else 0
+            retries = max(counts['attempts'] - counts['calls'], 0)
+            print(f"  {check:<14}{counts['runs']:>7}{counts['seconds']:>11.2f}{average:>9.1f}"
+                  f"{counts['calls']:>8}{retries:>9}{counts['throttles']:>11}{counts['bytes'] / 1024:>10.1f}")
+
+        if slowest_buckets:
+            print()
+            print("🐢 SLOWEST BUCKETS:")
+            for bucket_name, seconds in slowest_buckets:
+                print(f"  • {bucket_name} ({seconds:.2f}s)")
+
+        if slowest_checks:
+            print()
+            print("🐢 SLOWEST CHECKS:")
+            for seconds, bucket_name, check in slowest_checks:
+                print(f"  • {bucket_name} / {check} ({seconds:.2f}s)")
+
+    def write_prometheus(self, path):
+        """Write per-check counters in the node_exporter textfile format, replacing path atomically."""
+        with self._lock:
+            checks = {check: Counter(counts) for check, counts in self._checks.items()}
+            operations = Counter(self._operations)
+
+        metrics = (
+            ('check_runs_total', 'Checks run', lambda counts: counts['runs']),
+            ('check_seconds_total', 'Wall time spent in checks', lambda counts: counts['seconds']),
+            ('api_calls_total', 'boto3 API calls made', lambda counts: counts['calls']),
+            ('api_retries_total', 'HTTP attempts beyond the first', lambda counts: max(counts['attempts'] - counts['calls'], 0)),
+            ('api_throttles_total', 'Throttled responses', lambda counts: counts['throttles']),
+            ('api_bytes_received_total', 'Response bytes received', lambda counts: counts['bytes']),
+        )
+
+        lines = []
+        for name, help_text, value in metrics:
+            lines.append(f"# HELP s3_prodquery_{name} {help_text}")
+            lines.append(f"# TYPE s3_prodquery_{name} counter")
+            for check, counts in sorted(checks.items()):
+                lines.append(f's3_prodquery_{name}{{check="{check}"}} {value(counts)}')
+
+        lines.append("# HELP s3_prodquery_operation_calls_total boto3 API calls by operation")
+        lines.append("# TYPE s3_prodquery_operation_calls_total counter")
+        for (check, operation), calls in sorted(operations.items()):
+            lines.append(f's3_prodquery_operation_calls_total{{check="{check}",operation="{operation}"}} {calls}')
+
+        with open(f"{path}.tmp", 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f"{path}.tmp", path)
+
+
+class SignalCache:
+    """
+    Per-bucket signals persisted in SQLite, so re-runs only fetch what has gone stale.
+
+    Values are stored as JSON keyed by (bucket, kind), and each kind expires after its SIGNAL_TTLS entry.
+    """
+
+    def __init__(self, path, ttls=None):
+        self.ttls = dict(SIGNAL_TTLS, **(ttls or {}))
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS signals ('
+                'bucket TEXT NOT NULL, kind TEXT NOT NULL, value TEXT, fetched_at REAL NOT NULL, '
+                'PRIMARY KEY (bucket, kind))'
+            )
+
+    def get(self, bucket_name, kind):
+        """Return (True, value) for a fresh signal, or (False, None) when it's missing or stale."""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, fetched_at FROM signals WHERE bucket = ? AND kind = ?', (bucket_name, kind)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttls[kind]:
+            return False, None
+        return True, json.loads(row[0])
+
+    def is_fresh(self, bucket_name, kind):
+        return self.get(bucket_name, kind)[0]
+
+    def put(self, bucket_name, kind, value):
+        self.put_many(kind, [(bucket_name, value)])
+
+    def put_many(self, kind, items):
+        """Store (bucket, value) pairs for one kind of signal in a single transaction."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO signals (bucket, kind, value, fetched_at) VALUES (?, ?, ?, ?)',
+                [(bucket_name, kind, json.dumps(value), now) for bucket_name, value in items],
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
 class S3ProductionAnalyzer:
-    def __init__(self):
-        self.s3_client = boto3.client('s3')
-        self.cloudwatch_client = boto3.client('cloudwatch')
-    
+    def __init__(self, max_workers=16, check_workers=None, s3_concurrency=16, cloudwatch_concurrency=4,
+                 sizing='storage-metrics', inventory_root=None, crawl_fallback=False,
+                 crawl_stop_after=LARGE_OBJECT_COUNT, lazy=False, cache=None,
+                 recency=DEFAULT_RECENCY, prefix_scan_limit=100, prefix_scan_pages=1,
+                 request_metrics_filter=DEFAULT_REQUEST_METRICS_FILTER,
+                 session=None, account=None, sink=None, profiler=None):
+        self.max_workers = max_workers
+        self.profiler = profiler
+        self.sink = sink
+        self.session = session or boto3.Session()
+        self.account = account
+        self.default_region = self.session.region_name or 'us-east-1'
+        self.recency_chain = list(recency)
+        self.prefix_scan_limit = prefix_scan_limit
+        self.prefix_scan_pages = prefix_scan_pages
+        self.request_metrics_filter = request_metrics_filter
+        self.cache = cache
+        self.lazy = lazy
+        # The crawl is only ever used when asked for, directly or as the last resort.
+        self.sizing_chain = [sizing] + (['crawl'] if crawl_fallback and sizing != 'crawl' else [])
+        self.inventory_root = inventory_root
+        self.crawl_stop_after = crawl_stop_after
+        self._inventory_manifests = None
+        self._inventory_lock = threading.Lock()
+        self._inventory_summaries = {}
+        self._inventory_summary_locks = {}
+
+        # Per-region clients and call slots. S3 and CloudWatch throttle per region, so each
+        # region gets its own s3_concurrency/cloudwatch_concurrency budget.
+        self._client_config = Config(max_pool_connections=max(s3_concurrency, cloudwatch_concurrency, 10))
+        self._concurrency = {'s3': s3_concurrency, 'cloudwatch': cloudwatch_concurrency}
+        self._clients_lock = threading.Lock()
+        self._regional_clients = {}
+        self._api_slots = {}
+        self._bucket_regions = {}
+        self.s3_client, self.cloudwatch_client = self._clients_for(self.default_region)
+        # bucket -> {metric name: sum or None}, filled by prefetch_metrics().
+        self._metrics = {}
+        # Prefix scans fan out from inside a check, so they can't share the check pool either.
+        self._scan_pool = ThreadPoolExecutor(max_workers=s3_concurrency, thread_name_prefix='s3-scan')
+        # Checks get their own pool so bucket workers can block on them without deadlocking.
+        self._check_pool = ThreadPoolExecutor(
+            max_workers=check_workers or max_workers * len(CHECKS),
+            thread_name_prefix='s3-check',
+        )
+
+    def close(self):
+        """Shut down the check and prefix-scan pools; the analyzer can't score buckets afterwards."""
+        self._check_pool.shutdown(wait=True)
+        self._scan_pool.shutdown(wait=True)
+
+    def _clients_for(self, region):
+        """Return the (s3, cloudwatch) clients for a region, creating them on first use."""
+        with self._clients_lock:
+            if region not in self._regional_clients:
+                self._regional_clients[region] = (
+                    self.session.client('s3', region_name=region, config=self._client_config),
+                    self.session.client('cloudwatch', region_name=region, config=self._client_config),
+                )
+                if self.profiler is not None:
+                    for client in self._regional_clients[region]:
+                        self.profiler.attach(client)
+            return self._regional_clients[region]
+
+    def _profiled(self, bucket_name, check):
+        """The profiler's context for (bucket, check), or a no-op when profiling is off."""
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.context(bucket_name, check)
+
+    def _slot(self, api, region):
+        """The semaphore bounding in-flight calls to one API in one region."""
+        with self._clients_lock:
+            if (api, region) not in self._api_slots:
+                self._api_slots[(api, region)] = threading.BoundedSemaphore(self._concurrency[api])
+            return self._api_slots[(api, region)]
+
+    def _call(self, api, method, **kwargs):
+        """Make a single boto3 call while holding a concurrency slot for its API and region."""
+        with self._slot(api, method.__self__.meta.region_name):
+            return method(**kwargs)
+
+    def _paginate(self, api, client, operation, **kwargs):
+        """Yield pages from a paginator, holding an API slot only while each page is fetched."""
+        pages = iter(client.get_paginator(operation).paginate(**kwargs))
+        slot = self._slot(api, client.meta.region_name)
+        while True:
+            with slot:
+                page = next(pages, None)
+            if page is None:
+                return
+            yield page
+
+    def _region_of(self, bucket_name):
+        """
+        The region a bucket lives in, from ListBuckets, the cache or GetBucketLocation.
+
+        CloudWatch only has a bucket's metrics in its own region, so every call about a bucket
+        goes through that region's clients. When the location can't be read the default region is used.
+        """
+        region = self._bucket_regions.get(bucket_name)
+        if region is None:
+            try:
+                region = self._signal(bucket_name, 'region', lambda: self._fetch_region(bucket_name))
+            except ClientError:
+                return self.default_region
+            self._bucket_regions[bucket_name] = region
+        return region
+
+    def _fetch_region(self, bucket_name):
+        response = self._call('s3', self.s3_client.get_bucket_location, Bucket=bucket_name)
+        # us-east-1 reports no constraint, and the oldest Irish buckets still say 'EU'.
+        location = response.get('LocationConstraint') or 'us-east-1'
+        return 'eu-west-1' if location == 'EU' else location
+
+    def resolve_regions(self, bucket_names):
+        """Look up the region of every bucket in parallel, returning region -> [bucket names]."""
+        def region_of(bucket_name):
+            with self._profiled(bucket_name, 'region'):
+                return self._region_of(bucket_name)
+
+        bucket_names = list(bucket_names)
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='s3-region') as pool:
+            regions = pool.map(region_of, bucket_names)
+
+        by_region = {}
+        for bucket_name, region in zip(bucket_names, regions):
+            by_region.setdefault(region, []).append(bucket_name)
+        return by_region
+
+    def _s3(self, bucket_name):
+        return self._clients_for(self._region_of(bucket_name))[0]
+
+    def _cloudwatch(self, bucket_name):
+        return self._clients_for(self._region_of(bucket_name))[1]
+
+    def prefetch_metrics(self, bucket_names, metric_names=None):
+        """
+        Fetch CloudWatch metrics for all buckets with GetMetricData.
+
+        One call covers up to MAX_METRIC_DATA_QUERIES buckets, so a 900 bucket account costs
+        a handful of CloudWatch calls instead of one or more per bucket. Buckets with no
+        datapoints are recorded as None so the checks don't fall back to a per-bucket call.
+        By default this fetches the request metrics, plus the storage metrics when they back sizing.
+        Buckets whose cached value is still fresh are left out of the sweep, and each region's
+        buckets are swept in parallel through that region's CloudWatch client.
+        """
+        if metric_names is None:
+            metric_names = REQUEST_METRICS
+            if 'storage-metrics' in self.sizing_chain:
+                metric_names += STORAGE_METRICS
+            if 'put-metrics' in self.recency_chain:
+                metric_names += ('PutRequests',)
+
+        by_region = self.resolve_regions(bucket_names)
+        with ThreadPoolExecutor(max_workers=max(len(by_region), 1), thread_name_prefix='s3-metrics') as pool:
+            sweeps = [
+                pool.submit(self._prefetch_region, region, region_buckets, metric_names)
+                for region, region_buckets in by_region.items()
+            ]
+            for sweep in sweeps:
+                sweep.result()
+
+    def _prefetch_region(self, region, bucket_names, metric_names):
+        """Run the GetMetricData sweep for the buckets of one region."""
+        with self._profiled(f"[{region}]", 'prefetch'):
+            self._prefetch_region_metrics(region, bucket_names, metric_names)
+
+    def _prefetch_region_metrics(self, region, bucket_names, metric_names):
+        cloudwatch = self._clients_for(region)[1]
+        end_time = datetime.utcnow()
+
+        for metric_name in metric_names:
+            spec = METRICS[metric_name]
+            start_time = end_time - timedelta(days=spec['days'])
+            stale = [bucket_name for bucket_name in bucket_names if not self._has_fresh_signal(bucket_name, metric_name)]
+
+            for offset in range(0, len(stale), MAX_METRIC_DATA_QUERIES):
+                batch = stale[offset:offset + MAX_METRIC_DATA_QUERIES]
+                queries = [
+                    {
+                        'Id': f'm{index}',
+                        'MetricStat': {
+                            'Metric': {
+                                'Namespace': 'AWS/S3',
+                                'MetricName': metric_name,
+                                'Dimensions': self._metric_dimensions(metric_name, bucket_name),
+                            },
+                            'Period': spec['period'],
+                            'Stat': spec['stat'],
+                        },
+                    }
+                    for index, bucket_name in enumerate(batch)
+                ]
+
+                values = {}
+                for page in self._paginate(
+                    'cloudwatch',
+                    cloudwatch,
+                    'get_metric_data',
+                    MetricDataQueries=queries,
+                    StartTime=start_time,
+                    EndTime=end_time,
+                    ScanBy='TimestampDescending',
+                ):
+                    for series in page['MetricDataResults']:
+                        values.setdefault(series['Id'], []).extend(zip(series['Timestamps'], series['Values']))
+
+                fetched = [
+                    (bucket_name, self._reduce_metric(metric_name, values.get(f'm{index}')))
+                    for index, bucket_name in enumerate(batch)
+                ]
+                for bucket_name, value in fetched:
+                    self._metrics.setdefault(bucket_name, {})[metric_name] = value
+                if self.cache is not None:
+                    self.cache.put_many(metric_name, fetched)
+
+    def _has_fresh_signal(self, bucket_name, kind):
+        """True when the cache already holds a fresh value that makes fetching kind unnecessary."""
+        if self.cache is None:
+            return False
+        if kind in STORAGE_METRICS and self.cache.is_fresh(bucket_name, 'contents'):
+            return True
+        if kind == 'PutRequests' and self.cache.is_fresh(bucket_name, 'recency'):
+            return True
+        return self.cache.is_fresh(bucket_name, kind)
+
+    def _signal(self, bucket_name, kind, fetch):
+        """Return a cached signal when it's fresh, otherwise call fetch() and cache what it returns."""
+        if self.cache is not None:
+            hit, value = self.cache.get(bucket_name, kind)
+            if hit:
+                return value
+
+        value = fetch()
+        if self.cache is not None:
+            self.cache.put(bucket_name, kind, value)
+        return value
+
+    def _metric_dimensions(self, metric_name, bucket_name):
+        """CloudWatch dimensions identifying a bucket's series for a metric."""
+        dimensions = [{'Name': 'BucketName', 'Value': bucket_name}]
+        if METRICS[metric_name].get('filtered'):
+            dimensions.append({'Name': 'FilterId', 'Value': self.request_metrics_filter})
+        for name, value in METRICS[metric_name].get('dimensions', {}).items():
+            dimensions.append({'Name': name, 'Value': value})
+        return dimensions
+
+    @staticmethod
+    def _reduce_metric(metric_name, points):
+        """Collapse (timestamp, value) datapoints, newest first, into one value per METRICS['reduce']."""
+        if not points:
+            return None
+
+        reduce = METRICS[metric_name]['reduce']
+        if reduce == 'sum':
+            return sum(value for _timestamp, value in points)
+        if reduce == 'last-active':
+            active = [timestamp for timestamp, value in points if value > 0]
+            return {'last_active': max(active).isoformat() if active else None}
+        return points[0][1]
+
+    def _metric_value(self, bucket_name, metric_name):
+        """Return a bucket's value for a METRICS entry, or None when CloudWatch has no data."""
+        return self._signal(bucket_name, metric_name, lambda: self._fetch_metric(bucket_name, metric_name))
+
+    def _fetch_metric(self, bucket_name, metric_name):
+        """Read a metric from the prefetched table, falling back to a per-bucket CloudWatch call."""
+        prefetched = self._metrics.get(bucket_name, {})
+        if metric_name in prefetched:
+            return prefetched[metric_name]
+
+        # Not part of a prefetched sweep, ask CloudWatch for this bucket alone.
+        spec = METRICS[metric_name]
+        end_time = datetime.utcnow()
+        response = self._call(
+            'cloudwatch',
+            self._cloudwatch(bucket_name).get_metric_statistics,
+            Namespace='AWS/S3',
+            MetricName=metric_name,
+            Dimensions=self._metric_dimensions(metric_name, bucket_name),
+            StartTime=end_time - timedelta(days=spec['days']),
+            EndTime=end_time,
+            Period=spec['period'],
+            Statistics=[spec['stat']]
+        )
+
+        datapoints = sorted(response['Datapoints'], key=lambda x: x['Timestamp'], reverse=True)
+        return self._reduce_metric(metric_name, [(point['Timestamp'], point[spec['stat']]) for point in datapoints])
+
+    def score_bucket(self, bucket_name):
+        """
+        Run the checks for a bucket and return a structured result.
+
+        Normally every check runs concurrently. In lazy mode checks run in tiers of equal cost,
+        cheapest first, and the rest are skipped as soon as their min/max bounds can no longer
+        move the score into a different band.
+        """
+        started = time.monotonic()
+
+        if self.lazy:
+            tiers = {}
+            for check in CHECKS:
+                tiers.setdefault(check['cost'], []).append(check)
+            tiers = [tiers[cost] for cost in sorted(tiers)]
+        else:
+            tiers = [list(CHECKS)]
+
+        results = {}
+        score = 0
+        for index, tier in enumerate(tiers):
+            futures = [
+                (check, self._check_pool.submit(self._timed_check, check['name'], getattr(self, check['method']), bucket_name))
+                for check in tier
+            ]
+            for check, future in futures:
+                results[check['name']] = future.result()
+                score += results[check['name']]['score']
+
+            remaining = [check for later in tiers[index + 1:] for check in later]
+            if remaining and self._band_is_settled(score, remaining):
+                for check in remaining:
+                    results[check['name']] = {
+                        'score': 0,
+                        'indicators': [],
+                        'details': ["Skipped - band already decided"],
+                        'skipped': True,
+                        'seconds': 0.0,
+                    }
+                break
+
+        checks = []
+        for check in CHECKS:
+            result = results[check['name']]
+            result['check'] = check['name']
+            result['label'] = check['label']
+            checks.append(result)
+
+        return {
+            'bucket': bucket_name,
+            'account': self.account,
+            'region': self._region_of(bucket_name),
+            'score': score,
+            'band': score_band(score),
+            'indicators': [indicator for check in checks for indicator in check['indicators']],
+            'checks': checks,
+            'seconds': time.monotonic() - started,
+        }
+
+    @staticmethod
+    def _band_is_settled(score, remaining):
+        """True when no outcome of the remaining checks can change the band of score."""
+        lowest = score + sum(check['min'] for check in remaining)
+        highest = score + sum(check['max'] for check in remaining)
+        return score_band(lowest) == score_band(highest)
+
+    def _timed_check(self, name, check, bucket_name):
+        """Run one check, never letting an exception escape into the bucket worker."""
+        started = time.monotonic()
+        try:
+            with self._profiled(bucket_name, name):
+                result = check(bucket_name)
+        except Exception as e:
+            result = {'score': 0, 'indicators': [], 'details': [f"Error - {e}"]}
+        result['seconds'] = time.monotonic() - started
+        if self.profiler is not None:
+            self.profiler.record_check(bucket_name, name, result['seconds'])
+        return result
+
     def analyze_production_indicators(self, bucket_name):
         """Analyze a bucket for production indicators and return a score."""
-        prod_score = 0
-        indicators = []
-        
-        print(f"🔍 Production Indicators for: {bucket_name}")
-        
-        # 1. Check naming patterns
-        prod_score, indicators = self._check_naming_patterns(bucket_name, prod_score, indicators)
-        
-        # 2. Check tags
-        prod_score, indicators = self._check_tags(bucket_name, prod_score, indicators)
-        
-        # 3. Check recent activity (last 7 days)
-        prod_score, indicators = self._check_recent_activity(bucket_name, prod_score, indicators)
-        
-        # 4. Check data transfer (indicates real usage)
-        prod_score, indicators = self._check_data_transfer(bucket_name, prod_score, indicators)
-        
-        # 5. Check object count and size
-        prod_score, indicators = self._check_contents(bucket_name, prod_score, indicators)
-        
-        # 6. Check for recent modifications
-        prod_score, indicators = self._check_recent_modifications(bucket_name, prod_score, indicators)
-        
-        # Production likelihood assessment
-        self._print_assessment(prod_score, indicators)
-        
-        return prod_score
-    
-    def _check_naming_patterns(self, bucket_name, prod_score, indicators):
+        result = self.score_bucket(bucket_name)
+        self._print_assessment(result)
+        return result['score']
+
+    def _check_naming_patterns(self, bucket_name):
         """Check bucket name for production/non-production patterns."""
+        result = {'score': 0, 'indicators': [], 'details': []}
+
         if re.search(r'(prod|production)', bucket_name, re.IGNORECASE):
-            prod_score += 3
-            indicators.append("✅ Contains 'prod' in name (+3)")
+            result['score'] += 3
+            result['indicators'].append("✅ Contains 'prod' in name (+3)")
         elif re.search(r'(dev|development|test|staging|integration|sandbox)', bucket_name, re.IGNORECASE):
-            prod_score -= 2
-            indicators.append("❌ Contains non-prod keywords (-2)")
-        
-        return prod_score, indicators
-    
-    def _check_tags(self, bucket_name, prod_score, indicators):
+            result['score'] -= 2
+            result['indicators'].append("❌ Contains non-prod keywords (-2)")
+
+        return result
+
+    def _check_tags(self, bucket_name):
         """Check bucket tags for environment indicators."""
-        print("  📋 Checking tags...")
-        
+        result = {'score': 0, 'indicators': [], 'details': []}
+
+        try:
+            tags = self._signal(bucket_name, 'tags', lambda: self._fetch_tags(bucket_name))
+        except ClientError as e:
+            result['details'].append(f"Tags: Error accessing tags - {e}")
+            return result
+
+        if tags is None:
+            result['details'].append("Tags: None")
+            result['indicators'].append("⚠️  No tags (consider this suspicious)")
+            return result
+
+        # Look for environment-related tags
+        env_keys = ['Environment', 'environment', 'Env', 'env']
+        env_value = None
+
+        for key in env_keys:
+            if key in tags:
+                env_value = tags[key]
+                break
+
+        if env_value:
+            if re.match(r'^(prod|production|Production|PROD)$', env_value):
+                result['score'] += 5
+                result['indicators'].append(f"✅ Environment tag = {env_value} (+5)")
+            elif re.match(r'^(dev|development|test|staging|integration|sandbox)$', env_value):
+                result['score'] -= 3
+                result['indicators'].append(f"❌ Environment tag = {env_value} (-3)")
+
+        tag_display = ', '.join([f"{k}={v}" for k, v in tags.items()])
+        result['details'].append(f"Tags: {tag_display}")
+
+        return result
+
+    def _fetch_tags(self, bucket_name):
+        """Return a bucket's tags as a dict, or None when it has no tag set."""
         try:
-            response = self.s3_client.get_bucket_tagging(Bucket=bucket_name)
-            tags = {tag['Key']: tag['Value'] for tag in response['TagSet']}
-            
-            # Look for environment-related tags
-            env_keys = ['Environment', 'environment', 'Env', 'env']
-            env_value = None
-            
-            for key in env_keys:
-                if key in tags:
-                    env_value = tags[key]
-                    break
-            
-            if env_value:
-                if re.match(r'^(prod|production|Production|PROD)$', env_value):
-                    prod_score += 5
-                    indicators.append(f"✅ Environment tag = {env_value} (+5)")
-                elif re.match(r'^(dev|development|test|staging|integration|sandbox)$', env_value):
-                    prod_score -= 3
-                    indicators.append(f"❌ Environment tag = {env_value} (-3)")
-            
-            tag_display = ', '.join([f"{k}={v}" for k, v in tags.items()])
-            print(f"    Tags: {tag_display}")
-            
+            response = self._call('s3', self._s3(bucket_name).get_bucket_tagging, Bucket=bucket_name)
         except ClientError as e:
             if e.response['Error']['Code'] == 'NoSuchTagSet':
-                print("    Tags: None")
-                indicators.append("⚠️  No tags (consider this suspicious)")
-            else:
-                print(f"    Tags: Error accessing tags - {e}")
-        
-        return prod_score, indicators
-    
-    def _check_recent_activity(self, bucket_name, prod_score, indicators):
+                return None
+            raise
+        return {tag['Key']: tag['Value'] for tag in response['TagSet']}
+
+    def _check_recent_activity(self, bucket_name):
         """Check CloudWatch metrics for recent request activity."""
-        print("  📊 Checking recent activity...")
-        
+        result = {'score': 0, 'indicators': [], 'details': []}
+
         try:
-            end_time = datetime.utcnow()
-            start_time = end_time - timedelta(days=7)
-            
-            response = self.cloudwatch_client.get_metric_statistics(
-                Namespace='AWS/S3',
-                MetricName='AllRequests',
-                Dimensions=[
-                    {'Name': 'BucketName', 'Value': bucket_name}
-                ],
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=604800,  # 1 week
-                Statistics=['Sum']
-            )
-            
-            if response['Datapoints']:
-                recent_requests = response['Datapoints'][0]['Sum']
-                
+            recent_requests = self._metric_value(bucket_name, 'AllRequests')
+
+            if recent_requests is not None:
                 if recent_requests > 1000:
-                    prod_score += 3
-                    indicators.append(f"✅ High activity: {recent_requests:.0f} requests/week (+3)")
+                    result['score'] += 3
+                    result['indicators'].append(f"✅ High activity: {recent_requests:.0f} requests/week (+3)")
                 elif recent_requests > 100:
-                    prod_score += 1
-                    indicators.append(f"🔶 Moderate activity: {recent_requests:.0f} requests/week (+1)")
+                    result['score'] += 1
+                    result['indicators'].append(f"🔶 Moderate activity: {recent_requests:.0f} requests/week (+1)")
                 else:
-                    indicators.append(f"🔶 Low activity: {recent_requests:.0f} requests/week")
-                
-                print(f"    Recent requests (7d): {recent_requests:.0f}")
+                    result['indicators'].append(f"🔶 Low activity: {recent_requests:.0f} requests/week")
+
+                result['details'].append(f"Recent requests (7d): {recent_requests:.0f}")
             else:
-                print("    Recent requests (7d): No data or no activity")
-                indicators.append("❓ No recent activity data")
-                
+                result['details'].append("Recent requests (7d): No data or no activity")
+                result['indicators'].append("❓ No recent activity data")
+
         except Exception as e:
-            print(f"    Recent requests (7d): Error - {e}")
-            indicators.append("❓ Error checking activity")
-        
-        return prod_score, indicators
-    
-    def _check_data_transfer(self, bucket_name, prod_score, indicators):
+            result['details'].append(f"Recent requests (7d): Error - {e}")
+            result['indicators'].append("❓ Error checking activity")
+
+        return result
+
+    def _check_data_transfer(self, bucket_name):
         """Check data transfer metrics."""
-        print("  📈 Checking data transfer...")
-        
+        result = {'score': 0, 'indicators': [], 'details': []}
+
         try:
-            end_time = datetime.utcnow()
-            start_time = end_time - timedelta(days=30)
-            
-            response = self.cloudwatch_client.get_metric_statistics(
-                Namespace='AWS/S3',
-                MetricName='BytesDownloaded',
-                Dimensions=[
-                    {'Name': 'BucketName', 'Value': bucket_name}
-                ],
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=2592000,  # 30 days
-                Statistics=['Sum']
-            )
-            
-            if response['Datapoints']:
-                bytes_downloaded = response['Datapoints'][0]['Sum']
+            bytes_downloaded = self._metric_value(bucket_name, 'BytesDownloaded')
+
+            if bytes_downloaded is not None:
                 gb_downloaded = bytes_downloaded / (1024 ** 3)  # Convert to GB
-                
+
                 if gb_downloaded > 10:
-                    prod_score += 2
-                    indicators.append(f"✅ Significant data transfer: {gb_downloaded:.2f}GB downloaded (+2)")
-                
-                print(f"    Data downloaded (30d): {gb_downloaded:.2f}GB")
+                    result['score'] += 2
+                    result['indicators'].append(f"✅ Significant data transfer: {gb_downloaded:.2f}GB downloaded (+2)")
+
+                result['details'].append(f"Data downloaded (30d): {gb_downloaded:.2f}GB")
             else:
-                print("    Data downloaded (30d): No data")
-                
+                result['details'].append("Data downloaded (30d): No data")
+
         except Exception as e:
-            print(f"    Data downloaded (30d): Error - {e}")
-        
-        return prod_score, indicators
-    
-    def _check_contents(self, bucket_name, prod_score, indicators):
+            result['details'].append(f"Data downloaded (30d): Error - {e}")
+
+        return result
+
+    def _check_contents(self, bucket_name):
         """Check bucket contents for object count."""
-        print("  📦 Checking contents...")
-        
+        result = {'score': 0, 'indicators': [], 'details': []}
+
         try:
-            # Get object count using list_objects_v2 with pagination
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-            page_iterator = paginator.paginate(Bucket=bucket_name)
-            
-            object_count = 0
-            total_size = 0
-            
-            for page in page_iterator:
-                if 'Contents' in page:
-                    object_count += len(page['Contents'])
-                    total_size += sum(obj['Size'] for obj in page['Contents'])
-            
-            if object_count > 1000:
-                prod_score += 1
-                indicators.append(f"✅ Large object count: {object_count:,} objects (+1)")
-            
+            sizing = self._signal(bucket_name, 'contents', lambda: self._fetch_sizing(bucket_name))
+
+            if sizing is None:
+                result['details'].append(f"Contents: No data ({', '.join(self.sizing_chain)})")
+                return result
+
+            object_count = sizing['objects']
+            total_size = sizing['bytes']
+
+            # An inexact count stopped early and the bucket holds more than object_count objects.
+            if object_count > LARGE_OBJECT_COUNT or (not sizing['exact'] and object_count >= LARGE_OBJECT_COUNT):
+                result['score'] += 1
+                result['indicators'].append(f"✅ Large object count: {object_count:,}{'' if sizing['exact'] else '+'} objects (+1)")
+
+            if sizing['exact']:
+                result['details'].append(f"Total Objects: {object_count:,} ({sizing['source']})")
+            else:
+                result['details'].append(f"Total Objects: {object_count:,}+ ({sizing['source']}, stopped early)")
+
             # Convert size to human readable
             if total_size > 0:
                 size_gb = total_size / (1024 ** 3)
-                print(f"    Total Objects: {object_count:,}")
-                print(f"    Total Size: {size_gb:.2f} GB")
+                result['details'].append(f"Total Size: {'' if sizing['exact'] else '> '}{size_gb:.2f} GB")
             else:
-                print(f"    Total Objects: {object_count:,}")
-                print("    Total Size: 0 Bytes")
-                
+                result['details'].append("Total Size: 0 Bytes")
+
         except ClientError as e:
             if e.response['Error']['Code'] == 'AccessDenied':
-                print("    Contents: Access denied")
+                result['details'].append("Contents: Access denied")
             else:
-                print(f"    Contents: Error - {e}")
+                result['details'].append(f"Contents: Error - {e}")
         except Exception as e:
-            print(f"    Contents: Error - {e}")
-        
-        return prod_score, indicators
-    
-    def _check_recent_modifications(self, bucket_name, prod_score, indicators):
+            result['details'].append(f"Contents: Error - {e}")
+
+        return result
+
+    def _fetch_sizing(self, bucket_name):
+        """Ask each backend in the sizing chain in turn, returning the first answer."""
+        for backend in self.sizing_chain:
+            sizing = getattr(self, SIZING_BACKENDS[backend])(bucket_name)
+            if sizing is not None:
+                return sizing
+        return None
+
+    def _size_from_storage_metrics(self, bucket_name):
+        """Size a bucket from the daily BucketSizeBytes/NumberOfObjects storage metrics."""
+        object_count = self._metric_value(bucket_name, 'NumberOfObjects')
+        if object_count is None:
+            return None
+
+        total_size = self._metric_value(bucket_name, 'BucketSizeBytes') or 0
+        return {'objects': int(object_count), 'bytes': int(total_size), 'exact': True, 'source': 'storage-metrics'}
+
+    def _size_from_inventory(self, bucket_name):
+        """Size a bucket from its newest local S3 Inventory report."""
+        summary = self._inventory_summary(bucket_name)
+        if summary is None:
+            return None
+        return {'objects': summary['objects'], 'bytes': summary['bytes'], 'exact': True, 'source': 'inventory'}
+
+    def _inventory_summary(self, bucket_name):
+        """
+        Stream a bucket's newest inventory report once, keeping its count, size and newest LastModifiedDate.
+
+        Sizing and recency both read from the same summary, so the report is only streamed once per run.
+        """
+        if not self.inventory_root:
+            return None
+
+        with self._inventory_lock:
+            if self._inventory_manifests is None:
+                self._inventory_manifests = find_inventory_manifests(self.inventory_root)
+            bucket_lock = self._inventory_summary_locks.setdefault(bucket_name, threading.Lock())
+
+        manifest_path = self._inventory_manifests.get(bucket_name)
+        if manifest_path is None:
+            return None
+
+        with bucket_lock:
+            if bucket_name not in self._inventory_summaries:
+                object_count = 0
+                total_size = 0
+                newest = None
+                for row in iter_inventory_rows(manifest_path, self.inventory_root, columns=('size', 'last_modified_date')):
+                    object_count += 1
+                    total_size += int(row['size'] or 0)
+                    # Every row in a report has the same format, so CSV strings compare like the datetimes.
+                    if row['last_modified_date'] and (newest is None or row['last_modified_date'] > newest):
+                        newest = row['last_modified_date']
+
+                self._inventory_summaries[bucket_name] = {
+                    'objects': object_count,
+                    'bytes': total_size,
+                    'last_modified': parse_inventory_timestamp(newest).isoformat() if newest else None,
+                }
+
+        return self._inventory_summaries[bucket_name]
+
+    def _size_from_crawl(self, bucket_name):
+        """
+        Size a bucket by listing it, stopping once crawl_stop_after objects have been passed.
+
+        A truncated page that already holds crawl_stop_after keys proves the bucket is over the
+        cutoff, so the default 1000 needs a single ListObjectsV2 call. With crawl_stop_after=None
+        this is the old full crawl, one call per 1000 keys.
+        """
+        object_count = 0
+        total_size = 0
+
+        for page in self._paginate('s3', self._s3(bucket_name), 'list_objects_v2', Bucket=bucket_name):
+            if 'Contents' in page:
+                object_count += len(page['Contents'])
+                total_size += sum(obj['Size'] for obj in page['Contents'])
+
+            if self.crawl_stop_after is not None and (
+                object_count > self.crawl_stop_after
+                or (object_count >= self.crawl_stop_after and page.get('IsTruncated'))
+            ):
+                return {'objects': object_count, 'bytes': total_size, 'exact': False, 'source': 'crawl'}
+
+        return {'objects': object_count, 'bytes': total_size, 'exact': True, 'source': 'crawl'}
+
+    def _check_recent_modifications(self, bucket_name):
         """Check for recent object modifications."""
-        print("  🕒 Checking recent modifications...")
-        
+        result = {'score': 0, 'indicators': [], 'details': []}
+
         try:
-            response = self.s3_client.list_objects_v2(
-                Bucket=bucket_name,
-                MaxKeys=100
-            )
-            
-            if 'Contents' in response and response['Contents']:
-                # Sort by LastModified and get the most recent
-                sorted_objects = sorted(response['Contents'], key=lambda x: x['LastModified'], reverse=True)
-                most_recent = sorted_objects[0]['LastModified']
-                
+            recency = self._signal(bucket_name, 'recency', lambda: self._fetch_recency(bucket_name))
+
+            if recency is None:
+                result['details'].append(f"Last modification: No data ({', '.join(self.recency_chain)})")
+                return result
+
+            source = recency['source'] if recency['exact'] else f"{recency['source']}, sampled"
+            if recency['last_modified'] is not None:
+                most_recent = datetime.fromisoformat(recency['last_modified'])
+
                 # Check if modified in the last week
                 week_ago = datetime.now(most_recent.tzinfo) - timedelta(days=7)
-                
+
                 if most_recent > week_ago:
-                    prod_score += 1
-                    indicators.append(f"✅ Recently modified: {most_recent.strftime('%Y-%m-%d %H:%M:%S')} (+1)")
-                
-                print(f"    Last modification: {most_recent.strftime('%Y-%m-%d %H:%M:%S')}")
+                    result['score'] += 1
+                    result['indicators'].append(f"✅ Recently modified: {most_recent.strftime('%Y-%m-%d %H:%M:%S')} (+1)")
+
+                result['details'].append(f"Last modification: {most_recent.strftime('%Y-%m-%d %H:%M:%S')} ({source})")
+            elif recency['source'] == 'put-metrics':
+                result['details'].append(f"Last modification: None in the last {METRICS['PutRequests']['days']} days ({source})")
             else:
-                print("    Last modification: No objects")
-                
+                result['details'].append("Last modification: No objects")
+
         except ClientError as e:
             if e.response['Error']['Code'] == 'AccessDenied':
-                print("    Last modification: Access denied")
+                result['details'].append("Last modification: Access denied")
             else:
-                print(f"    Last modification: Error - {e}")
+                result['details'].append(f"Last modification: Error - {e}")
         except Exception as e:
-            print(f"    Last modification: Error - {e}")
-        
-        return prod_score, indicators
-    
-    def _print_assessment(self, prod_score, indicators):
-        """Print the production assessment."""
+            result['details'].append(f"Last modification: Error - {e}")
+
+        return result
+
+    def _fetch_recency(self, bucket_name):
+        """Ask each backend in the recency chain in turn, returning the first answer."""
+        for backend in self.recency_chain:
+            recency = getattr(self, RECENCY_BACKENDS[backend])(bucket_name)
+            if recency is not None:
+                return recency
+        return None
+
+    def _recency_from_inventory(self, bucket_name):
+        """Newest LastModifiedDate in the bucket's latest inventory report."""
+        summary = self._inventory_summary(bucket_name)
+        if summary is None:
+            return None
+        return {'last_modified': summary['last_modified'], 'source': 'inventory', 'exact': True}
+
+    def _recency_from_put_metrics(self, bucket_name):
+        """
+        Newest day with PutRequests in the last week, from the daily request metric.
+
+        Read from the request_metrics_filter filter; buckets without request metrics enabled for
+        it have no datapoints at all and fall through to the next backend. Day granularity is plenty for a "modified this week" check.
+        """
+        activity = self._metric_value(bucket_name, 'PutRequests')
+        if activity is None:
+            return None
+        return {'last_modified': activity['last_active'], 'source': 'put-metrics', 'exact': True}
+
+    def _recency_from_prefix_scan(self, bucket_name):
+        """
+        Keep a running max of LastModified across many prefixes listed in parallel.
+
+        One delimited listing finds the top-level prefixes (and root-level objects). Then up to
+        prefix_scan_limit prefixes each get prefix_scan_pages pages listed at once. The answer is
+        exact only when every listing ran to the end. Otherwise it is the newest write in a bounded
+        sample that is spread across the keyspace instead of taken from its first 100 keys.
+        """
+        response = self._call('s3', self._s3(bucket_name).list_objects_v2, Bucket=bucket_name, Delimiter='/')
+        prefixes = [prefix['Prefix'] for prefix in response.get('CommonPrefixes', [])]
+        exact = not response.get('IsTruncated') and len(prefixes) <= self.prefix_scan_limit
+
+        newest = max((obj['LastModified'] for obj in response.get('Contents', [])), default=None)
+        scans = [
+            # Run in a copy of this context so the profiler still credits the scan to this check.
+            self._scan_pool.submit(contextvars.copy_context().run, self._newest_under_prefix, bucket_name, prefix)
+            for prefix in prefixes[:self.prefix_scan_limit]
+        ]
+        for scan in scans:
+            prefix_newest, complete = scan.result()
+            exact = exact and complete
+            if prefix_newest is not None and (newest is None or prefix_newest > newest):
+                newest = prefix_newest
+
+        return {'last_modified': newest.isoformat() if newest else None, 'source': 'prefix-scan', 'exact': exact}
+
+    def _newest_under_prefix(self, bucket_name, prefix):
+        """List up to prefix_scan_pages pages under a prefix; return (newest LastModified, listed everything)."""
+        newest = None
+        pages = self._paginate('s3', self._s3(bucket_name), 'list_objects_v2', Bucket=bucket_name, Prefix=prefix)
+        for page_number, page in enumerate(pages, 1):
+            for obj in page.get('Contents', []):
+                if newest is None or obj['LastModified'] > newest:
+                    newest = obj['LastModified']
+            if page_number >= self.prefix_scan_pages:
+                return newest, not page.get('IsTruncated')
+        return newest, True
+
+    def _recency_from_sample(self, bucket_name):
+        """Newest LastModified among the first 100 keys. Cheap, but only right for small buckets."""
+        response = self._call(
+            's3',
+            self._s3(bucket_name).list_objects_v2,
+            Bucket=bucket_name,
+            MaxKeys=100
+        )
+
+        contents = response.get('Contents', [])
+        newest = max((obj['LastModified'] for obj in contents), default=None)
+        return {
+            'last_modified': newest.isoformat() if newest else None,
+            'source': 'sample',
+            'exact': not response.get('IsTruncated'),
+        }
+
+    def _print_assessment(self, result):
+        """Print the production assessment for a scored bucket."""
+        print(f"🔍 Production Indicators for: {result['bucket']}")
+
+        if 'error' in result:
+            print(f"  ❌ Error scoring bucket: {result['error']}")
+            print("  " + "=" * 60)
+            return
+
+        for check in result['checks']:
+            if check['label']:
+                print(f"  {check['label']}")
+            for detail in check['details']:
+                print(f"    {detail}")
+
         print()
         print("  🎯 PRODUCTION ASSESSMENT:")
-        for indicator in indicators:
+        for indicator in result['indicators']:
             print(f"    {indicator}")
-        
-        print(f"  📊 Production Score: {prod_score}")
-        
-        if prod_score >= 5:
+
+        print(f"  📊 Production Score: {result['score']}")
+
+        band = result['band']
+        if band == 'RED':
             print("  🔴 LIKELY PRODUCTION - High confidence")
-        elif prod_score >= 2:
+        elif band == 'YELLOW':
             print("  🟡 POSSIBLY PRODUCTION - Medium confidence")
-        elif prod_score >= 0:
+        elif band == 'GREEN':
             print("  🟢 LIKELY NON-PRODUCTION - Low risk")
         else:
             print("  ⚪ CLEARLY NON-PRODUCTION - Safe to investigate")
-        
+
         print("  " + "=" * 60)
-    
-    def analyze_all_buckets(self):
-        """Analyze all S3 buckets in the account."""
+
+    def _safe_score_bucket(self, bucket_name):
+        """Score a bucket, turning unexpected failures into an error result, and hand it to the sink."""
+        result = self._score_or_error(bucket_name)
+        if self.profiler is not None and 'seconds' in result:
+            self.profiler.record_bucket(bucket_name, result['seconds'])
+        if self.sink is not None:
+            # Written from the worker, so records stream out in completion order.
+            self.sink.write(result)
+        return result
+
+    def _score_or_error(self, bucket_name):
+        try:
+            return self.score_bucket(bucket_name)
+        except Exception as e:
+            return {
+                'bucket': bucket_name,
+                'account': self.account,
+                'region': self._bucket_regions.get(bucket_name),
+                'score': 0,
+                'band': score_band(0),
+                'error': str(e),
+            }
+
+    def iter_bucket_results(self, bucket_names):
+        """
+        Score buckets in parallel, yielding results in input order as soon as each is ready.
+
+        At most max_workers * 2 buckets are in flight, so memory stays bounded on large accounts.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='s3-bucket') as pool:
+            pending = deque()
+            for bucket_name in bucket_names:
+                pending.append(pool.submit(self._safe_score_bucket, bucket_name))
+                if len(pending) >= self.max_workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def analyze_buckets(self, bucket_names):
+        """Score the given buckets and return their results in input order."""
+        return list(self.iter_bucket_results(bucket_names))
+
+    def list_bucket_names(self):
+        """List the names of all buckets in the account, remembering any regions ListBuckets reports."""
+        with self._profiled('-', 'list'):
+            response = self._call('s3', self.s3_client.list_buckets)
+        for bucket in response['Buckets']:
+            if bucket.get('BucketRegion'):
+                self._bucket_regions[bucket['Name']] = bucket['BucketRegion']
+        return [bucket['Name'] for bucket in response['Buckets']]
+
+    def analyze_all_buckets(self, report=True, keep_results=True):
+        """
+        Analyze all S3 buckets in the account.
+
+        With report=False nothing is printed and listing errors are raised, for callers like
+        analyze_accounts() that render several accounts' results themselves. With
+        keep_results=False only the RED/YELLOW summary is held in memory, so a sink can
+        stream a huge account at constant memory.
+        """
+        if report:
+            print("S3 Bucket Production Analysis")
+            print("=" * 29)
+
+        try:
+            bucket_names = self.list_bucket_names()
+        except (ClientError, BotoCoreError) as e:
+            if not report:
+                raise
+            print(f"Error listing buckets: {e}")
+            return []
+
+        try:
+            self.prefetch_metrics(bucket_names)
+        except (ClientError, BotoCoreError) as e:
+            if report:
+                print(f"⚠️  Batched metrics unavailable, falling back to per-bucket calls: {e}")
+
+        production_buckets = []
+        maybe_production = []
+        results = []
+
+        for result in self.iter_bucket_results(bucket_names):
+            if keep_results:
+                results.append(result)
+            if not report:
+                continue
+
+            print()
+            self._print_assessment(result)
+
+            if result['band'] == 'RED':
+                production_buckets.append((result['bucket'], result['score']))
+            elif result['band'] == 'YELLOW':
+                maybe_production.append((result['bucket'], result['score']))
+
+            print()
+
+        if report:
+            self._print_summary(production_buckets, maybe_production)
+        return results
+
+    def _print_summary(self, production_buckets, maybe_production):
+        """Print the summary recommendations and the RED/YELLOW bucket lists."""
+        print()
+        print("🎯 SUMMARY RECOMMENDATIONS:")
+        print("• RED (5+ points): Treat as production, investigate carefully")
+        print("• YELLOW (2-4 points): Verify with team before making changes")
+        print("• GREEN (0-1 points): Likely safe for cleanup/investigation")
+        print("• WHITE (negative): Development/test buckets")
+
+        if production_buckets:
+            print()
+            print("🔴 HIGH CONFIDENCE PRODUCTION BUCKETS:")
+            for bucket_name, score in sorted(production_buckets, key=lambda x: x[1], reverse=True):
+                print(f"  • {bucket_name} (score: {score})")
+
+        if maybe_production:
+            print()
+            print("🟡 POSSIBLE PRODUCTION BUCKETS:")
+            for bucket_name, score in sorted(maybe_production, key=lambda x: x[1], reverse=True):
+                print(f"  • {bucket_name} (score: {score})")
+
+
+def assume_role_session(role_arn, region_name=None, session_name='s3-prodquery'):
+    """
+    Return (account id, boto3 Session) acting as role_arn.
+
+    The credentials re-assume the role shortly before they expire, so scoring a large account
+    can outlast the one-hour STS session.
+    """
+    sts_client = boto3.client('sts')
+
+    def assume():
+        credentials = sts_client.assume_role(RoleArn=role_arn, RoleSessionName=session_name)['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+
+    botocore_session = botocore.session.get_session()
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=assume(), refresh_using=assume, method='sts-assume-role',
+    )
+    return role_arn.split(':')[4], boto3.Session(botocore_session=botocore_session, region_name=region_name)
+
+
+def analyze_accounts(role_arns, account_workers=4, report=True, **analyzer_kwargs):
+    """
+    Score every bucket in each role's account, several accounts at a time.
+
+    Accounts are scored concurrently but reported one after another in role order, followed by
+    a single summary across the whole org. Returns {account id: results}. With report=False
+    nothing is printed or kept; results only go to the analyzers' sink.
+    """
+    def score_account(role_arn):
+        account, session = assume_role_session(role_arn, region_name=boto3.Session().region_name)
+        analyzer = S3ProductionAnalyzer(session=session, account=account, **analyzer_kwargs)
+        try:
+            return account, analyzer, analyzer.analyze_all_buckets(report=False, keep_results=report)
+        finally:
+            analyzer.close()
+
+    if report:
         print("S3 Bucket Production Analysis")
         print("=" * 29)
-        
-        try:
-            response = self.s3_client.list_buckets()
-            buckets = response['Buckets']
-            
-            production_buckets = []
-            maybe_production = []
-            
-            for bucket in buckets:
-                bucket_name = bucket['Name']
-                print()
-                score = self.analyze_production_indicators(bucket_name)
-                
-                if score >= 5:
-                    production_buckets.append((bucket_name, score))
-                elif score >= 2:
-                    maybe_production.append((bucket_name, score))
-                
-                print()
-            
-            # Print summary
+
+    production_buckets = []
+    maybe_production = []
+    results_by_account = {}
+    analyzer = None
+
+    with ThreadPoolExecutor(max_workers=account_workers, thread_name_prefix='s3-account') as pool:
+        # Popped as they're reported, so a finished account's results and clients can be freed.
+        accounts = deque((role_arn, pool.submit(score_account, role_arn)) for role_arn in role_arns)
+
+        while accounts:
+            role_arn, future = accounts.popleft()
+            try:
+                account, analyzer, results = future.result()
+            except (ClientError, BotoCoreError) as e:
+                print(f"❌ Error analyzing {role_arn}: {e}")
+                continue
+
+            results_by_account[account] = results
+            if not report:
+                continue
+
             print()
-            print("🎯 SUMMARY RECOMMENDATIONS:")
-            print("• RED (5+ points): Treat as production, investigate carefully")
-            print("• YELLOW (2-4 points): Verify with team before making changes")
-            print("• GREEN (0-1 points): Likely safe for cleanup/investigation")
-            print("• WHITE (negative): Development/test buckets")
-            
-            if production_buckets:
-                print()
-                print("🔴 HIGH CONFIDENCE PRODUCTION BUCKETS:")
-                for bucket_name, score in sorted(production_buckets, key=lambda x: x[1], reverse=True):
-                    print(f"  • {bucket_name} (score: {score})")
-            
-            if maybe_production:
+            print(f"🏢 Account {account}: {len(results)} buckets")
+            print("=" * 60)
+            for result in results:
                 print()
-                print("🟡 POSSIBLE PRODUCTION BUCKETS:")
-                for bucket_name, score in sorted(maybe_production, key=lambda x: x[1], reverse=True):
-                    print(f"  • {bucket_name} (score: {score})")
-                    
-        except Exception as e:
-            print(f"Error listing buckets: {e}")
+                analyzer._print_assessment(result)
+
+                label = f"{account}/{result['bucket']}"
+                if result['band'] == 'RED':
+                    production_buckets.append((label, result['score']))
+                elif result['band'] == 'YELLOW':
+                    maybe_production.append((label, result['score']))
+
+    if report and analyzer is not None:
+        analyzer._print_summary(production_buckets, maybe_production)
+    return results_by_account
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Score S3 buckets by how likely they are to be production.')
+    parser.add_argument('--workers', type=int, default=16, help='Buckets scored in parallel')
+    parser.add_argument('--s3-concurrency', type=int, default=16, help='Max in-flight S3 API calls')
+    parser.add_argument('--cloudwatch-concurrency', type=int, default=4, help='Max in-flight CloudWatch API calls')
+    parser.add_argument('--sizing', choices=sorted(SIZING_BACKENDS), default='storage-metrics',
+                        help='Where object counts and sizes come from')
+    parser.add_argument('--inventory-root', help='Local mirror of the S3 Inventory destination bucket')
+    parser.add_argument('--crawl-fallback', action='store_true',
+                        help='List the bucket when the sizing backend has no data for it')
+    parser.add_argument('--lazy', action='store_true',
+                        help='Skip the remaining checks once a bucket\'s band can no longer change')
+    parser.add_argument('--cache', metavar='PATH',
+                        help='SQLite file caching per-bucket signals between runs')
+    parser.add_argument('--recency', default=','.join(DEFAULT_RECENCY),
+                        help=f"Comma-separated recency backends to try in order ({', '.join(RECENCY_BACKENDS)})")
+    parser.add_argument('--request-metrics-filter', default=DEFAULT_REQUEST_METRICS_FILTER,
+                        help='FilterId of the S3 request metrics configuration to read request metrics from')
+    parser.add_argument('--prefix-scan-limit', type=int, default=100,
+                        help='Most top-level prefixes the prefix-scan backend lists per bucket')
+    parser.add_argument('--prefix-scan-pages', type=int, default=1,
+                        help='ListObjectsV2 pages the prefix-scan backend reads per prefix')
+    parser.add_argument('--role-arn', action='append', default=[],
+                        help='Assume this role and score its account; repeat for more accounts')
+    parser.add_argument('--roles-file', help='File with one role ARN per line to score')
+    parser.add_argument('--account-workers', type=int, default=4, help='Accounts scored in parallel')
+    parser.add_argument('--output', metavar='PATH', help='Stream one record per bucket to this file')
+    parser.add_argument('--format', choices=sorted(RESULT_SINKS), default='jsonl', help='Format for --output')
+    parser.add_argument('--quiet', action='store_true', help='Skip the text report, only write --output')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print per-check wall time, API calls, retries and throttles at the end')
+    parser.add_argument('--prometheus-textfile', metavar='PATH',
+                        help='Also write the profile as a Prometheus node_exporter textfile')
+    parser.add_argument('--full-crawl', action='store_true',
+                        help=f'Keep listing past {LARGE_OBJECT_COUNT:,} objects to get exact totals')
+    args = parser.parse_args()
+
+    unknown = set(args.recency.split(',')) - set(RECENCY_BACKENDS)
+    if unknown:
+        parser.error(f"unknown recency backend(s): {', '.join(sorted(unknown))}")
+    if args.sizing == 'inventory' and not args.inventory_root:
+        parser.error('--sizing inventory requires --inventory-root')
+    return args
+
 
 def main():
     """Main execution function."""
-    analyzer = S3ProductionAnalyzer()
-    analyzer.analyze_all_buckets()
+    args = parse_args()
+    cache = SignalCache(args.cache) if args.cache else None
+    sink = RESULT_SINKS[args.format](args.output) if args.output else None
+    profiler = CallProfiler() if args.profile or args.prometheus_textfile else None
+
+    role_arns = list(args.role_arn)
+    if args.roles_file:
+        with open(args.roles_file) as f:
+            role_arns.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+
+    analyzer_kwargs = dict(
+        max_workers=args.workers,
+        s3_concurrency=args.s3_concurrency,
+        cloudwatch_concurrency=args.cloudwatch_concurrency,
+        sizing=args.sizing,
+        inventory_root=args.inventory_root,
+        crawl_fallback=args.crawl_fallback,
+        crawl_stop_after=None if args.full_crawl else LARGE_OBJECT_COUNT,
+        lazy=args.lazy,
+        cache=cache,
+        recency=args.recency.split(','),
+        prefix_scan_limit=args.prefix_scan_limit,
+        prefix_scan_pages=args.prefix_scan_pages,
+        request_metrics_filter=args.request_metrics_filter,
+        sink=sink,
+        profiler=profiler,
+    )
+    try:
+        if role_arns:
+            analyze_accounts(role_arns, account_workers=args.account_workers, report=not args.quiet, **analyzer_kwargs)
+        else:
+            analyzer = S3ProductionAnalyzer(**analyzer_kwargs)
+            try:
+                analyzer.analyze_all_buckets(report=not args.quiet, keep_results=False)
+            finally:
+                analyzer.close()
+    except (ClientError, BotoCoreError) as e:
+        print(f"Error listing buckets: {e}")
+    finally:
+        if sink is not None:
+            sink.close()
+        if profiler is not None:
+            if args.profile:
+                profiler.print_summary()
+            if args.prometheus_textfile:
+                profiler.write_prometheus(args.prometheus_textfile)
+        if cache is not None:
+            cache.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()